@@ -0,0 +1,147 @@
+import os
+import queue
+import threading
+from concurrent.futures import Future
+
+import numpy as np
+import tensorflow as tf
+
+
+class CheckpointWriter(threading.Thread):
+    """
+    Save checkpoints in background. The values of variables are copied to host memory in the training
+    thread, and written by a separate graph in this thread, so that training continues during writing.
+    A checkpoint is written to a temporary prefix and renamed once complete, and only the last
+    keep_last checkpoints and the best checkpoint by metric of each directory are kept. Each save returns a
+    future, which is resolved once the index file of checkpoint has been renamed into place, or fails with
+    the error of writing. The first failure is raised again by the next save or wait.
+    """
+
+    def __init__(self, var_list: list, keep_last: int = 5, queue_size: int = 2):
+        """
+        :param var_list: The variables to be saved.
+        :param keep_last: The number of latest checkpoints kept in each directory, None keeps all checkpoints.
+        :param queue_size: The maximum number of checkpoints waiting to be written.
+        """
+        threading.Thread.__init__(self, name='CheckpointWriter', daemon=True)
+        self.var_list = var_list
+        self.variables = [(var.op.name, var.dtype.base_dtype, var.shape.as_list()) for var in var_list]
+        self.keep_last = keep_last
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.error = None
+
+        # Dictionary maps directory to the list of (epoch, save_path, metric) of kept checkpoints
+        self.checkpoints = dict()
+
+        self.graph = None
+        self.sess = None
+        self.saver = None
+        self.assign_ops = None
+        self.value_places = None
+
+    def save(self, sess: tf.Session, save_path: str, epoch: int, metric: float = None) -> Future:
+        """
+        Snapshot the variables and queue them to be written.
+        :param sess: The session of variables.
+        :param save_path: The prefix of checkpoint.
+        :param epoch: The epoch of checkpoint.
+        :param metric: The metric used to select the best checkpoint, the lower the better.
+        :return: The future resolved to save_path once the checkpoint has been written.
+        """
+        self.raise_error()
+        values = sess.run(self.var_list)
+        future = Future()
+        self.queue.put((values, save_path, epoch, metric, future))
+        return future
+
+    def wait(self):
+        """
+        Block until all queued checkpoints have been written.
+        """
+        self.queue.join()
+        self.raise_error()
+
+    def raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise IOError('Failed to save checkpoint: {:s}'.format(str(error))) from error
+
+    def close(self):
+        self.queue.put(None)
+        self.join()
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                values, save_path, epoch, metric, future = item
+                try:
+                    self.write(values=values, save_path=save_path, epoch=epoch, metric=metric)
+                except Exception as e:
+                    if self.error is None:
+                        self.error = e
+                    future.set_exception(e)
+                else:
+                    future.set_result(save_path)
+            finally:
+                self.queue.task_done()
+
+    def build(self):
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            self.value_places = list()
+            self.assign_ops = list()
+            variables = dict()
+            for name, dtype, shape in self.variables:
+                variable = tf.Variable(initial_value=tf.zeros(shape=shape, dtype=dtype), name=name)
+                value_place = tf.placeholder(dtype=dtype, shape=shape)
+                self.value_places.append(value_place)
+                self.assign_ops.append(tf.assign(variable, value_place))
+                variables[name] = variable
+            self.saver = tf.train.Saver(var_list=variables, max_to_keep=None)
+        self.sess = tf.Session(graph=self.graph)
+
+    def write(self, values: list, save_path: str, epoch: int, metric: float = None):
+        if self.graph is None:
+            self.build()
+
+        save_dir, save_name = os.path.split(save_path)
+        if not os.path.exists(save_dir):
+            os.makedirs(save_dir)
+
+        temp_path = save_path + '.tmp'
+        self.sess.run(self.assign_ops, feed_dict=dict(zip(self.value_places, values)))
+        self.saver.save(self.sess, temp_path, write_meta_graph=False, write_state=False)
+
+        # Rename the index file last, a checkpoint without index is never restored
+        temp_name = os.path.basename(temp_path)
+        temp_files = sorted([file for file in os.listdir(save_dir) if file.startswith(temp_name + '.')],
+                            key=lambda file: file.endswith('.index'))
+        for temp_file in temp_files:
+            os.replace(os.path.join(save_dir, temp_file),
+                       os.path.join(save_dir, save_name + temp_file[len(temp_name):]))
+
+        self.checkpoints.setdefault(save_dir, list()).append((epoch, save_path, metric))
+        self.remove_checkpoints(save_dir=save_dir)
+
+    def remove_checkpoints(self, save_dir: str):
+        checkpoints = self.checkpoints[save_dir]
+        if self.keep_last is None or len(checkpoints) <= self.keep_last:
+            return
+
+        kept = checkpoints[-self.keep_last:]
+        metrics = [checkpoint[2] if checkpoint[2] is not None else np.inf for checkpoint in checkpoints]
+        best = checkpoints[int(np.argmin(metrics))]
+        if np.isfinite(min(metrics)) and best not in kept:
+            kept.insert(0, best)
+
+        for checkpoint in checkpoints:
+            if checkpoint in kept:
+                continue
+            save_name = os.path.basename(checkpoint[1])
+            for file in os.listdir(save_dir):
+                if file.startswith(save_name + '.'):
+                    os.remove(os.path.join(save_dir, file))
+        self.checkpoints[save_dir] = kept
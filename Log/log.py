@@ -4,6 +4,10 @@ import time
 import logging
 import scipy.io as sio
 import tensorflow as tf
+from Log.checkpoint import CheckpointWriter
+from Log.manifest import RunManifest
+from Log.profiler import timed
+from Log.summary import SummaryWorker
 from Structure.Schemes.xml_parse import parse_log_parameters
 
 
@@ -13,33 +17,50 @@ class Log:
     restored_time = None
     sub_folder_name = None
     pa = {'restored_epoch': 0,
+          'summary_steps': 20,
+          'summary_seconds': 10,
+          'console_seconds': 0.5,
+          'log_queue_size': 1000,
+          'keep_checkpoints': 5,
           }
 
     graph = None
     sess = None
+    config = None
     file_path = None
     train_writer = None
+    summary_worker = None
+    saver = None
+    checkpoint_writer = None
+    manifest = None
+    stage = None
+    process_list = ['pre_train_SCAE', 'fine_tune_SCAE', 'pre_train_Classifier', 'fine_tune_Classifier']
+    console_time = 0
 
     def __init__(self,
                  graph=None,
                  sess=None,
                  restored_date=None,
                  restore_time=None,
-                 sub_folder_name=None):
+                 sub_folder_name=None,
+                 config: tf.ConfigProto = None):
         self.set_file_path(restored_date=restored_date,
                            restore_time=restore_time,
                            sub_folder_name=sub_folder_name,
                            )
-        self.set_graph(graph=graph, sess=sess)
+        self.set_graph(graph=graph, sess=sess, config=config)
 
-    def set_graph(self, graph=None, sess=None):
+    def set_graph(self, graph=None, sess=None, config: tf.ConfigProto = None):
         if graph:
             self.graph = graph
         else:
             self.graph = tf.Graph()
 
+        if config:
+            self.config = config
+
         if not sess:
-            with tf.Session(graph=self.graph) as sess:
+            with tf.Session(graph=self.graph, config=self.config) as sess:
                 self.sess = sess
 
     def set_file_path(self, restored_date=None, restore_time=None, sub_folder_name=None):
@@ -68,28 +89,67 @@ class Log:
         self.file_path = '/'.join([self.basic_path, self.restored_date, self.restored_time])
         self.file_path += '/{:s}'.format(self.sub_folder_name) if self.sub_folder_name else ''
 
+    def set_stage(self, fold: str, process: str, indexes: list = None):
+        """
+        Set the training stage, the checkpoints are recorded in the manifest of run with the stage.
+        The subfolder is set such as 'fold 1/pre_train_SCAE/0-1'.
+        :param fold: The name of fold, such as 'fold 1'.
+        :param process: The training process in process_list.
+        :param indexes: The indexes of trained autoencoders, None if all autoencoders are trained.
+        :return:
+        """
+        self.stage = {'fold': fold,
+                      'process': process,
+                      'indexes': list(indexes) if indexes is not None else None,
+                      }
+        subfolder_name = '{:s}/{:s}'.format(fold, process)
+        if indexes is not None:
+            subfolder_name += '/{:s}'.format('-'.join([str(i) for i in indexes]))
+        self.set_filepath_by_subfolder(subfolder_name=subfolder_name)
+
     def get_save_dir(self):
         save_dir = '/'.join([self.basic_path, self.restored_date, self.restored_time])
         return save_dir
 
+    def get_manifest(self) -> RunManifest:
+        """
+        The manifest of checkpoints of current run, stored under the save directory.
+        """
+        manifest_path = '/'.join([self.get_save_dir(), 'manifest.jsonl'])
+        if self.manifest is None or self.manifest.file_path != manifest_path:
+            self.manifest = RunManifest(file_path=manifest_path)
+        return self.manifest
+
     def get_restored_pa(self):
-        pas = {}
-        if self.sub_folder_name is None:
+        """
+        The stage of the latest checkpoint of current run.
+        :return: Dictionary with the index of fold, the index of process and the indexes of autoencoders,
+                 None if no checkpoint has been recorded.
+        """
+        record = self.get_manifest().last_record
+        if record is None:
             return None
-        pas_list = self.sub_folder_name.split('/')
-        pas['fold'] = int(pas_list[0].split(' ')[1])
-        process_list = ['pre_train_SCAE', 'fine_tune_SCAE', 'pre_train_Classifier', 'fine_tune_Classifier']
-        pas['process'] = process_list.index(pas_list[1])
-        if pas['process'] == 'pre_train_SCAE' and len(pas_list) == 3:
-            pas['indexes'] = [int(i) for i in pas_list[2].split('-')]
-        else:
-            pas['indexes'] = None
-        return pas
+        return {'fold': int(record['fold'].split(' ')[-1]),
+                'process': self.process_list.index(record['process']),
+                'indexes': record['indexes'],
+                }
 
     def write_graph(self):
         if not os.path.exists(self.file_path):
             os.makedirs(self.file_path)
         print('Write Graph to File {:s}'.format(self.file_path + '\log'))
+
+        if self.summary_worker is None:
+            self.summary_worker = SummaryWorker(queue_size=self.pa['log_queue_size'],
+                                                summary_steps=self.pa['summary_steps'],
+                                                summary_seconds=self.pa['summary_seconds'],
+                                                )
+            self.summary_worker.start()
+        elif self.train_writer is not None:
+            # Write the remaining summaries before switching the writer
+            self.summary_worker.flush()
+            self.train_writer.close()
+
         self.train_writer = tf.summary.FileWriter(self.file_path + '\log', graph=self.graph)
 
     def write_log(self, res: dict,
@@ -99,71 +159,163 @@ class Log:
                   show_info: bool = True,
                   pre_fix: str = None,
                   new_line: bool = False,
+                  aggregate: bool = False,
                   ):
+        """
+        Write the results to console and TensorBoard, the summaries are written in background.
+        :param res: Dictionary of scalar results.
+        :param epoch: The epoch or global step of results.
+        :param log_type: The type of results, such as 'Train', 'Valid' or 'Test'.
+        :param if_save: Write the results to TensorBoard.
+        :param show_info: Write the results to console.
+        :param pre_fix: The prefix of console message.
+        :param new_line: Write the console message in a new line.
+        :param aggregate: The results are logged every step, which are averaged in TensorBoard and
+                          written to console at most every console_seconds seconds.
+        :return:
+        """
         error_str = '{:5s}:  {:2d}  '.format(log_type, epoch) + (pre_fix if pre_fix else '')
 
-        value = list()
+        values = dict()
         for res_key in sorted(res):
             tag = '{:5s} {:s}'.format(log_type, res_key)
             try:
-                value.append(tf.Summary.Value(tag=tag, simple_value=res[res_key]))
+                values[tag] = float(res[res_key])
             except:
                 continue
-            train_summaries = tf.Summary(value=value)
 
             error_str += '{:5s}: {:.5e}  '.format(res_key, res[res_key])
 
         if show_info:
-            if new_line:
-                error_str = '\r\n' + error_str + '\r\n'
-            else:
-                error_str = '\r' + error_str
-            sys.stdout.write(error_str)
+            console_time = time.time()
+            if not aggregate or new_line or console_time - self.console_time >= self.pa['console_seconds']:
+                if new_line:
+                    error_str = '\r\n' + error_str + '\r\n'
+                else:
+                    error_str = '\r' + error_str
+                sys.stdout.write(error_str)
+                self.console_time = console_time
 
-        if epoch > 0 and if_save:
-            self.train_writer.add_summary(train_summaries, epoch)
+        if epoch > 0 and if_save and values:
+            self.summary_worker.add(writer=self.train_writer,
+                                    values=values,
+                                    step=epoch,
+                                    aggregate=aggregate)
 
     def close(self):
+        if self.summary_worker is not None:
+            self.summary_worker.close()
+            self.summary_worker = None
+        if self.checkpoint_writer is not None:
+            self.checkpoint_writer.close()
+            self.checkpoint_writer = None
         self.train_writer.close()
 
-    def save_model(self, epoch, show_info: bool = True, save_path: str = None):
+    def set_saver(self, var_list: list, max_to_keep: int = 1000):
+        """
+        Set the saver of variables, the checkpoints are saved in background.
+        :param var_list: The variables to be saved and restored.
+        :param max_to_keep: The maximum number of checkpoints kept by the saver.
+        :return:
+        """
+        self.saver = tf.train.Saver(var_list, max_to_keep=max_to_keep, name='saver')
+        if self.checkpoint_writer is not None:
+            self.checkpoint_writer.close()
+        self.checkpoint_writer = CheckpointWriter(var_list=var_list, keep_last=self.pa['keep_checkpoints'])
+        self.checkpoint_writer.start()
+
+    @timed('checkpoint')
+    def save_model(self, epoch, show_info: bool = True, save_path: str = None, metric: float = None):
+        """
+        Save the model, which is written in background if the saver is set by set_saver. The checkpoint is
+        recorded in the manifest once written, and a failed write is raised by the next save or restore.
+        :param epoch: The training epoch of model.
+        :param show_info: Print the save path.
+        :param save_path: The prefix of checkpoint.
+        :param metric: The validation metric of model, the best checkpoint by metric is always kept.
+        :return: The prefix of checkpoint.
+        """
         if save_path is None:
             save_path = os.path.join(self.file_path,
                                      'model/train.model_{:d}'.format(epoch))
-        self.saver.save(self.sess, save_path)
-        if show_info:
-            print('Model saved in file: {:s}'.format(save_path))
+
+        # The manifest and stage are captured now, since the checkpoint may be written after the stage changes
+        stage = dict(self.stage) if self.stage is not None else None
+        manifest = self.get_manifest() if stage is not None else None
+
+        def saved():
+            if manifest is not None:
+                metrics = {'Valid MSE': float(metric)} if metric is not None else None
+                manifest.add(epoch=epoch, save_path=save_path, metrics=metrics, **stage)
+            if show_info:
+                print('Model saved in file: {:s}'.format(save_path))
+
+        if self.checkpoint_writer is None:
+            self.saver.save(self.sess, save_path)
+            saved()
+            return save_path
+
+        # Record the checkpoint in the manifest only once its index file is in place
+        future = self.checkpoint_writer.save(sess=self.sess,
+                                             save_path=save_path,
+                                             epoch=epoch,
+                                             metric=metric)
+
+        def done(finished):
+            if finished.exception() is not None:
+                print('\r\nFailed to save model in file {:s}: {:s}'.format(save_path, str(finished.exception())))
+            else:
+                saved()
+
+        future.add_done_callback(done)
         return save_path
 
+    @timed('restore')
     def restore(self,
                 restored_epoch: int = None,
                 restored_path: str = None,
-                initialize: bool = True) -> int:
+                initialize: bool = True,
+                best: bool = False) -> int:
         """
-        Restored neural network model with restore parameters.
-        :param restored_epoch: Restored model by epoch
+        Restored neural network model with restore parameters. Without restored path, the latest valid
+        checkpoint of current stage is looked up in the manifest of run.
+        :param restored_epoch: Restored model by epoch, the latest epoch by default.
         :param restored_path: Restored model directly by save path.
         :param initialize: Initialize the restore epoch after restored.
-        :return: The training epoch of restored model.
+        :param best: Restore the checkpoint of current stage with the lowest validation MSE instead of
+                     the latest, falls back to the latest if no checkpoint has been validated.
+        :return: The training epoch of restored model, 0 if no checkpoint is restored.
         """
+        # Wait for the checkpoints being written
+        if self.checkpoint_writer is not None:
+            self.checkpoint_writer.wait()
+
+        if restored_epoch is None and self.pa['restored_epoch']:
+            restored_epoch = self.pa['restored_epoch']
+
+        manifest = self.get_manifest()
         if restored_path is None:
-            if restored_epoch is None:
-                restored_epoch = self.pa['restored_epoch']
-            restored_path = os.path.join(self.file_path,
-                                         'model/train.model_{:d}'.format(restored_epoch)) if restored_epoch else None
-
-        try:
-            self.saver.restore(self.sess, restored_path)
-            restored_epoch = int(restored_path.split('_')[-1])
-            print('Model restored from file: {:s}'.format(restored_path))
-        except Exception as e:
-            print(e)
-            return 0
+            record = None
+            if self.stage and best and restored_epoch is None:
+                record = manifest.best(**self.stage)
+            if record is None and self.stage:
+                record = manifest.latest(epoch=restored_epoch, **self.stage)
+            if record is None:
+                print('No checkpoint to restore in {:s}.'.format(self.file_path))
+                return 0
+            restored_path = record['save_path']
+            restored_epoch = record['epoch']
+        else:
+            record = manifest.find(save_path=restored_path)
+            restored_epoch = record['epoch'] if record else 0
+
+        self.saver.restore(self.sess, restored_path)
+        print('Model restored from file: {:s}'.format(restored_path))
 
         if initialize:
             self.pa['restored_epoch'] = None
 
-        return restored_epoch if restored_epoch else 0
+        return restored_epoch
 
     def save_features(self, debug_train, debug_test, train_label, test_label, epoch=None, save_path=None):
         if not epoch:
@@ -0,0 +1,132 @@
+import json
+import os
+import threading
+import time
+
+
+class RunManifest:
+    """
+    Index of the checkpoints of a run, stored as JSON lines with one record per saved checkpoint.
+    The records are loaded once and grouped by (fold, process, indexes), so that the latest
+    checkpoint of a stage is found without parsing paths.
+    """
+
+    def __init__(self, file_path: str):
+        """
+        :param file_path: The path of manifest file.
+        """
+        self.file_path = file_path
+        self.lock = threading.Lock()
+        self.records = dict()
+        self.last_record = None
+
+        if os.path.exists(file_path):
+            with open(file_path, 'r') as file:
+                for line in file:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        self.index(json.loads(line))
+                    except ValueError:
+                        # Skip the line truncated by a crash
+                        continue
+
+    @staticmethod
+    def get_key(fold: str, process: str, indexes: list = None) -> tuple:
+        return fold, process, tuple(indexes) if indexes is not None else None
+
+    def index(self, record: dict):
+        key = self.get_key(fold=record['fold'], process=record['process'], indexes=record['indexes'])
+        self.records.setdefault(key, list()).append(record)
+        self.last_record = record
+
+    def add(self,
+            fold: str,
+            process: str,
+            indexes: list,
+            epoch: int,
+            save_path: str,
+            metrics: dict = None,
+            ):
+        """
+        Record a saved checkpoint.
+        :param fold: The name of fold, such as 'fold 1'.
+        :param process: The training process, such as 'pre_train_SCAE'.
+        :param indexes: The indexes of trained autoencoders, None if all autoencoders are trained.
+        :param epoch: The epoch of checkpoint.
+        :param save_path: The prefix of checkpoint.
+        :param metrics: Dictionary of the scalar metrics of checkpoint.
+        """
+        record = {'fold': fold,
+                  'process': process,
+                  'indexes': list(indexes) if indexes is not None else None,
+                  'epoch': int(epoch),
+                  'save_path': save_path,
+                  'metrics': metrics if metrics else dict(),
+                  'time': time.time(),
+                  }
+        with self.lock:
+            save_dir = os.path.dirname(self.file_path)
+            if not os.path.exists(save_dir):
+                os.makedirs(save_dir)
+            with open(self.file_path, 'a') as file:
+                file.write(json.dumps(record) + '\n')
+                file.flush()
+            self.index(record)
+
+    def latest(self, fold: str, process: str, indexes: list = None, epoch: int = None) -> dict:
+        """
+        The latest valid checkpoint of a stage, whose files still exist.
+        :param fold: The name of fold.
+        :param process: The training process.
+        :param indexes: The indexes of trained autoencoders.
+        :param epoch: Only look for the checkpoint of this epoch.
+        :return: The record of checkpoint, None if not found.
+        """
+        with self.lock:
+            records = list(self.records.get(self.get_key(fold=fold, process=process, indexes=indexes), []))
+
+        for record in reversed(records):
+            if epoch is not None and record['epoch'] != epoch:
+                continue
+            if is_valid_checkpoint(record['save_path']):
+                return record
+        return None
+
+    def best(self, fold: str, process: str, indexes: list = None, metric: str = 'Valid MSE') -> dict:
+        """
+        The valid checkpoint of a stage with the lowest metric.
+        :param fold: The name of fold.
+        :param process: The training process.
+        :param indexes: The indexes of trained autoencoders.
+        :param metric: The name of metric, the lower the better.
+        :return: The record of checkpoint, None if no checkpoint has the metric.
+        """
+        with self.lock:
+            records = list(self.records.get(self.get_key(fold=fold, process=process, indexes=indexes), []))
+
+        best_record = None
+        for record in records:
+            value = record['metrics'].get(metric)
+            if value is None or not is_valid_checkpoint(record['save_path']):
+                continue
+            # The later checkpoint wins the tie
+            if best_record is None or value <= best_record['metrics'][metric]:
+                best_record = record
+        return best_record
+
+    def find(self, save_path: str) -> dict:
+        """
+        The record of a checkpoint by its prefix.
+        """
+        with self.lock:
+            for records in self.records.values():
+                for record in records:
+                    if record['save_path'] == save_path:
+                        return record
+        return None
+
+
+def is_valid_checkpoint(save_path: str) -> bool:
+    return os.path.exists(save_path + '.index')
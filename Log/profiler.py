@@ -0,0 +1,206 @@
+import csv
+import functools
+import os
+import threading
+import time
+
+
+class NullPhase:
+    """
+    The phase of disabled profiler, which does nothing.
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+
+class Phase:
+
+    def __init__(self, profiler, name: str):
+        self.profiler = profiler
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.profiler.add(name=self.name, seconds=time.perf_counter() - self.start)
+        return False
+
+
+null_phase = NullPhase()
+
+
+class Profiler:
+    """
+    Accumulate the wall time of the phases of training, such as data load, optimizer step and checkpoint,
+    and emit the totals of each epoch to TensorBoard and a CSV file. The phases may be nested or run
+    in background threads, so their times are not exclusive. Disabled by default, in which case a phase
+    costs one attribute check.
+    """
+
+    def __init__(self, enabled: bool = False, csv_path: str = None, trace_step: int = None):
+        """
+        :param enabled: Time the phases.
+        :param csv_path: The CSV file of the times of each epoch, 'profile.csv' under the log folder by default.
+        :param trace_step: Capture the tf.RunMetadata of this optimizer step (counted from 1) as a timeline.
+        """
+        self.enabled = False
+        self.csv_path = None
+        self.trace_step = None
+        self.lock = threading.Lock()
+        self.times = dict()
+        self.steps = 0
+        self.run_metadata = None
+        self.configure(enabled=enabled, csv_path=csv_path, trace_step=trace_step)
+
+    def configure(self, enabled: bool = True, csv_path: str = None, trace_step: int = None):
+        self.enabled = enabled
+        self.csv_path = csv_path
+        self.trace_step = trace_step
+        self.reset()
+        self.steps = 0
+
+    def phase(self, name: str):
+        """
+        Context manager timing the enclosed block as phase name.
+        """
+        if not self.enabled:
+            return null_phase
+        return Phase(profiler=self, name=name)
+
+    def iterate(self, iterable, name: str):
+        """
+        Time the wait for each item of iterable as phase name.
+        """
+        if not self.enabled:
+            return iterable
+        return self.iterate_timed(iterable=iterable, name=name)
+
+    def iterate_timed(self, iterable, name: str):
+        iterator = iter(iterable)
+        while True:
+            with Phase(profiler=self, name=name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def add(self, name: str, seconds: float):
+        with self.lock:
+            total_count = self.times.setdefault(name, [0., 0])
+            total_count[0] += seconds
+            total_count[1] += 1
+
+    def reset(self):
+        with self.lock:
+            self.times = dict()
+
+    def run_kwargs(self) -> dict:
+        """
+        The keyword arguments of session.run for an optimizer step, which capture the RunMetadata at trace_step.
+        """
+        if not self.enabled:
+            return {}
+        self.steps += 1
+        if self.steps != self.trace_step:
+            return {}
+
+        import tensorflow as tf
+
+        self.run_metadata = tf.RunMetadata()
+        return {'options': tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE),
+                'run_metadata': self.run_metadata,
+                }
+
+    def end_epoch(self, epoch: int, log=None) -> dict:
+        """
+        Emit the times of the epoch and reset them.
+        :param epoch: The epoch of times.
+        :param log: The Log whose TensorBoard writer and folder receive the times and trace.
+        :return: Dictionary maps phase to its seconds in the epoch.
+        """
+        if not self.enabled:
+            return {}
+
+        with self.lock:
+            times, self.times = self.times, dict()
+        results = {name: total_count[0] for name, total_count in times.items()}
+
+        if log is not None:
+            log.write_log(res=results, epoch=epoch, log_type='Time', show_info=False)
+            if self.run_metadata is not None:
+                self.write_trace(log=log)
+
+        csv_path = self.csv_path
+        if csv_path is None and log is not None:
+            csv_path = os.path.join(log.file_path, 'profile.csv')
+        if csv_path is not None:
+            self.write_csv(csv_path=csv_path, epoch=epoch, times=times)
+        return results
+
+    @staticmethod
+    def write_csv(csv_path: str, epoch: int, times: dict):
+        save_dir = os.path.dirname(csv_path)
+        if save_dir and not os.path.exists(save_dir):
+            os.makedirs(save_dir)
+
+        new_file = not os.path.exists(csv_path)
+        with open(csv_path, 'a', newline='') as file:
+            writer = csv.writer(file)
+            if new_file:
+                writer.writerow(['epoch', 'phase', 'seconds', 'count'])
+            for name in sorted(times):
+                writer.writerow([epoch, name, '{:.6f}'.format(times[name][0]), times[name][1]])
+
+    def write_trace(self, log):
+        from tensorflow.python.client import timeline
+
+        trace = timeline.Timeline(self.run_metadata.step_stats).generate_chrome_trace_format()
+        trace_path = os.path.join(log.file_path, 'timeline step {:d}.json'.format(self.trace_step))
+        if not os.path.exists(log.file_path):
+            os.makedirs(log.file_path)
+        with open(trace_path, 'w') as file:
+            file.write(trace)
+        if log.train_writer is not None:
+            log.train_writer.add_run_metadata(self.run_metadata, 'step {:d}'.format(self.trace_step))
+        print('Write trace of step {:d} to {:s}'.format(self.trace_step, trace_path))
+        self.run_metadata = None
+
+
+# The profiler shared by the training pipeline, enabled by set_profiler
+profiler = Profiler()
+
+
+def set_profiler(enabled: bool = True, csv_path: str = None, trace_step: int = None) -> Profiler:
+    """
+    Enable or disable the profiler of the training pipeline, see Profiler.
+    """
+    profiler.configure(enabled=enabled, csv_path=csv_path, trace_step=trace_step)
+    return profiler
+
+
+def timed(name: str = None):
+    """
+    Decorator timing each call of the function as a phase, named by the function by default.
+    """
+
+    def decorator(function):
+        phase_name = name or function.__name__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not profiler.enabled:
+                return function(*args, **kwargs)
+            with Phase(profiler=profiler, name=phase_name):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
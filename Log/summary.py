@@ -0,0 +1,112 @@
+import queue
+import threading
+import time
+
+import tensorflow as tf
+
+
+class SummaryWorker(threading.Thread):
+    """
+    Write the scalar summaries of TensorBoard in background. The scalars logged every step are averaged
+    and written every summary_steps steps or summary_seconds seconds, the others are written directly.
+    """
+
+    def __init__(self,
+                 queue_size: int = 1000,
+                 summary_steps: int = 20,
+                 summary_seconds: float = 10,
+                 ):
+        """
+        :param queue_size: The maximum number of logs waiting to be written.
+        :param summary_steps: The number of steps averaged into a summary.
+        :param summary_seconds: The maximum seconds before averaged summaries are written.
+        """
+        threading.Thread.__init__(self, name='SummaryWorker', daemon=True)
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.summary_steps = summary_steps
+        self.summary_seconds = summary_seconds
+
+        # Dictionary maps writer to the sum and count of each tag, the last step and the number of steps
+        self.pending = dict()
+        self.emit_time = time.time()
+        # The writers written since last flush
+        self.writers = set()
+
+    def add(self, writer: tf.summary.FileWriter, values: dict, step: int, aggregate: bool = False):
+        """
+        Queue the scalars to be written.
+        :param writer: The file writer of summaries.
+        :param values: Dictionary maps tag to scalar.
+        :param step: The global step of scalars.
+        :param aggregate: Average the scalars with the scalars of following steps.
+        """
+        self.queue.put(('add', (writer, values, step, aggregate)))
+
+    def flush(self):
+        """
+        Block until all queued scalars have been written.
+        """
+        self.queue.put(('flush', None))
+        self.queue.join()
+
+    def close(self):
+        self.queue.put(('close', None))
+        self.join()
+
+    def run(self):
+        while True:
+            try:
+                command, item = self.queue.get(timeout=self.summary_seconds)
+            except queue.Empty:
+                self.emit()
+                continue
+
+            try:
+                if command == 'add':
+                    self.write(*item)
+                elif command == 'flush':
+                    self.emit(flush=True)
+                elif command == 'close':
+                    self.emit(flush=True)
+                    return
+            except Exception as e:
+                # Never stop logging because of a failed summary
+                print(e)
+            finally:
+                self.queue.task_done()
+
+    def write(self, writer: tf.summary.FileWriter, values: dict, step: int, aggregate: bool):
+        self.writers.add(writer)
+        if not aggregate:
+            summary = tf.Summary(value=[tf.Summary.Value(tag=tag, simple_value=values[tag])
+                                        for tag in sorted(values)])
+            writer.add_summary(summary, step)
+            return
+
+        pending = self.pending.setdefault(writer, {'values': dict(), 'step': step, 'steps': 0})
+        for tag, value in values.items():
+            sum_count = pending['values'].setdefault(tag, [0., 0])
+            sum_count[0] += value
+            sum_count[1] += 1
+        pending['step'] = step
+        pending['steps'] += 1
+
+        if pending['steps'] >= self.summary_steps or time.time() - self.emit_time >= self.summary_seconds:
+            self.emit()
+
+    def emit(self, flush: bool = False):
+        """
+        Write the averaged scalars.
+        :param flush: Flush the writers to disk.
+        """
+        for writer, pending in self.pending.items():
+            summary = tf.Summary(value=[tf.Summary.Value(tag=tag, simple_value=sum_count[0] / sum_count[1])
+                                        for tag, sum_count in sorted(pending['values'].items())])
+            writer.add_summary(summary, pending['step'])
+        self.pending = dict()
+        self.emit_time = time.time()
+
+        if flush:
+            for writer in self.writers:
+                writer.flush()
+            self.writers = set()
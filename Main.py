@@ -1,31 +1,64 @@
+import time
+
 import numpy as np
 
 from Log.log import Log
+from Structure.cache import set_fold_cache
 from Structure.Framework import Framework
+from Structure.scheduler import FoldScheduler, merge_results, session_config, set_jit, train_framework_fold
 from data.utils_prepare_data import basic_path, hdf5_handler
 
 
-def main():
+def main(workers: int = 1, cache_dir: str = None, jit_enabled: bool = False):
+    """
+    :param workers: The number of processes training the folds in parallel.
+    :param cache_dir: The directory of the fold cache, where the datasets of folds are materialized once
+                      and shared by all runs and workers. None reads the hdf5 file in every run.
+    :param jit_enabled: Compile the training step with XLA.
+    """
     start_time = 8
     stop_time = 10
     save = True
 
-    log = Log()
     scheme = 'CNNWithGLasso'
 
-    frame = Framework(scheme=scheme, log=log)
     # Training
     start_fold = 1
     end_fold = 5
-    for time in np.arange(start=start_time, stop=stop_time + 1):
-        frame.train_folds(start_fold=start_fold,
-                          end_fold=end_fold,
-                          run_time=time,
-                          show_info=True,
-                          save_result=save,
-                          )
+    if workers <= 1:
+        set_fold_cache(cache_dir=cache_dir)
+        set_jit(enabled=jit_enabled)
+        log = Log(config=session_config())
+        frame = Framework(scheme=scheme, log=log)
+        for run_time in np.arange(start=start_time, stop=stop_time + 1):
+            frame.train_folds(start_fold=start_fold,
+                              end_fold=end_fold,
+                              run_time=run_time,
+                              show_info=True,
+                              save_result=save,
+                              )
+            start_fold = 1
+        return
+
+    # Run the folds in parallel, each job logs into its own folder named after this run
+    jobs = list()
+    for run_time in np.arange(start=start_time, stop=stop_time + 1):
+        jobs.extend([(int(run_time), fold) for fold in range(start_fold, end_fold + 1)])
         start_fold = 1
 
+    scheduler = FoldScheduler(workers=workers)
+    results = scheduler.run(train_framework_fold,
+                            jobs=jobs,
+                            scheme=scheme,
+                            restored_date=time.strftime('%Y-%m-%d', time.localtime(time.time())),
+                            restore_time=time.strftime('%H-%M', time.localtime(time.time())),
+                            cache_dir=cache_dir,
+                            jit_enabled=jit_enabled,
+                            show_info=False,
+                            save_result=save,
+                            )
+    return merge_results(results)
+
 
 def rerun():
     save = True
@@ -42,5 +75,6 @@ def rerun():
                           save_result=save)
 
 
-main()
-# rerun()
+if __name__ == '__main__':
+    main()
+    # rerun()
@@ -2,9 +2,54 @@ import numpy as np
 import tensorflow as tf
 
 from Structure.Layer.LayerObject import LayerObject
+from Structure.precision import cast, get_compute_dtype
 from Structure.utils_structure import load_initial_value
 
 
+class SICEParameterization:
+    """
+    Parameterize the SICE weights as W = L * L^T, where L is the lower triangular matrix filled by the
+    variable in the order of tf.contrib.distributions.fill_triangular with its diagonal shifted by one.
+    The gather indexes are computed once, and the diagonal is shared by the weight and the log determinant.
+    """
+
+    def __init__(self, L, n_features: int, name: str = 'weight'):
+        """
+        :param L: The variable with shape [in_channels, out_channels, n_features * (n_features + 1) / 2].
+        :param n_features: The number of features.
+        :param name: The name of weight.
+        """
+        tril_indexes, diagonal_indexes = fill_triangular_indexes(n_features=n_features)
+        batch_shape = L.shape.as_list()[:-1]
+
+        # The upper triangular and diagonal elements gather the appended zero
+        L_padded = tf.concat([L, tf.zeros_like(L[..., :1])], axis=-1)
+        L_strict = tf.reshape(tf.gather(L_padded, tril_indexes, axis=len(batch_shape)),
+                              shape=batch_shape + [n_features, n_features])
+
+        self.diagonal = tf.gather(L, diagonal_indexes, axis=len(batch_shape)) + 1
+        self.L_tril = tf.matrix_set_diag(L_strict, self.diagonal)
+        self.weight = tf.matmul(self.L_tril, self.L_tril, transpose_b=True, name=name)
+        self.log_diagonal = tf.log(tf.square(self.diagonal))
+
+
+def fill_triangular_indexes(n_features: int):
+    """
+    The indexes of tf.contrib.distributions.fill_triangular, the index n_features * (n_features + 1) / 2
+    refers to zero.
+    :param n_features: The number of rows of the lower triangular matrix.
+    :return: The flatten indexes of the strictly lower triangular matrix, and the indexes of diagonal.
+    """
+    length = int(n_features * (n_features + 1) / 2)
+    indexes = np.arange(length)
+    indexes = np.reshape(np.concatenate((indexes[n_features:], indexes[::-1])), [n_features, n_features])
+    indexes[np.triu_indices(n_features, 1)] = length
+
+    diagonal_indexes = np.copy(np.diag(indexes))
+    indexes[np.diag_indices(n_features)] = length
+    return indexes.flatten(), diagonal_indexes
+
+
 class EdgeToEdgeWithGLasso(LayerObject):
     """
 
@@ -25,11 +70,15 @@ class EdgeToEdgeWithGLasso(LayerObject):
                                  'conv_fun': tf.nn.conv2d,
                                  'padding': 'SAME',
                                  'scope': 'E2EGLasso',
+                                 'vectorize': True,
+                                 'compute_dtype': None,
                                  })
         self.tensors = {}
 
         self.pa = self.set_parameters(arguments=arguments,
                                       parameters=parameters)
+        # The variables are kept in float32, the convolution is computed in the dtype of precision policy
+        self.compute_dtype = get_compute_dtype(self.pa['compute_dtype'])
 
         n_features, n_features, in_channels, out_channels = self.pa['kernel_shape']
         out_channels *= self.pa['n_class']
@@ -44,14 +93,10 @@ class EdgeToEdgeWithGLasso(LayerObject):
                         )
 
         # build weights
-        L_tril = tf.contrib.distributions.fill_triangular(L) + \
-                 tf.eye(num_rows=n_features,
-                        batch_shape=[in_channels, out_channels])
+        self.SICE = SICEParameterization(L=L, n_features=n_features)
+        self.tensors['L'] = self.SICE.L_tril
 
-        self.tensors['L'] = L_tril
-
-        weight = tf.transpose(a=tf.matmul(L_tril, tf.transpose(L_tril, perm=[0, 1, 3, 2]), name='weight'),
-                              perm=[3, 2, 0, 1])
+        weight = tf.transpose(a=self.SICE.weight, perm=[3, 2, 0, 1])
         self.tensors['weight'] = weight
 
         # build bias
@@ -72,26 +117,14 @@ class EdgeToEdgeWithGLasso(LayerObject):
         if len(shape) == 3:
             input_tensor = tf.expand_dims(input_tensor, axis=-1)
 
-        # convolution
+        # convolution, the output is kept in the compute dtype and only the regularizer is computed in float32
         weight = self.tensors['weight']
-
-        # Since the weights are naturally symmetric, it does not need to transpose
-        # weight = tf.transpose(weight, perm=[1, 0, 2, 3])
-
-        weight_slices = tf.split(weight, axis=0, num_or_size_splits=self.pa['kernel_shape'][0])
-        output = []
-        for weight_slice in weight_slices:
-            feature_map = self.pa['conv_fun'](input_tensor,
-                                              weight_slice,
-                                              strides=self.pa['strides'],
-                                              padding=self.pa['padding'],
-                                              )
-            output.append(feature_map)
-        output = tf.concat(output, axis=2)
+        output = self.convolution(input_tensor=input_tensor, vectorize=self.pa['vectorize'])
         self.tensors['output_conv'] = output
 
         # Build sparse inverse covariance matrix regularization
-        SICE_regularizer = build_SICE_regularizer(weight, self.tensors['L'], output)
+        SICE_regularizer = build_SICE_regularizer(weight, self.tensors['L'], output,
+                                                  log_diagonal=self.SICE.log_diagonal)
         SICE_regularizer = tf.transpose(tf.reshape(SICE_regularizer,
                                                    shape=[-1, self.pa['n_class'], self.pa['kernel_shape'][3]]),
                                         perm=[2, 0, 1])
@@ -115,16 +148,16 @@ class EdgeToEdgeWithGLasso(LayerObject):
 
         # bias
         if self.pa['bias']:
-            output = output + self.bias
+            output = output + cast(self.bias, self.compute_dtype)
             self.tensors['output_bias'] = output
 
-        # batch_normalization
+        # batch_normalization, whose statistics are computed in float32
         if self.pa['batch_normalization']:
-            output = self.batch_normalization(tensor=output,
+            output = self.batch_normalization(tensor=cast(output, tf.float32),
                                               scope=self.pa['scope'] + '/bn',
                                               training=training)
             self.tensors.update(output)
-            output = self.tensors['output_bn']
+            output = cast(self.tensors['output_bn'], self.compute_dtype)
 
         # activation
         if self.pa['activation']:
@@ -134,6 +167,50 @@ class EdgeToEdgeWithGLasso(LayerObject):
         self.tensors['output'] = output
         return output
 
+    def convolution(self, input_tensor, vectorize: bool = True):
+        """
+        Convolve the input with each row of the weight and concatenate the feature maps along axis 2.
+        :param input_tensor: The input tensor with shape [batch_size, n_features, n_features, in_channels].
+        :param vectorize: Compute all rows in a single convolution, otherwise convolve each row separately.
+        :return: The feature maps with shape [batch_size, n_features, n_features * width, out_channels],
+                 in the compute dtype of layer.
+        """
+        weight = cast(self.tensors['weight'], self.compute_dtype)
+        input_tensor = cast(input_tensor, self.compute_dtype)
+        n_features, _, in_channels, out_channels = weight.shape.as_list()
+
+        # Since the weights are naturally symmetric, it does not need to transpose
+        # weight = tf.transpose(weight, perm=[1, 0, 2, 3])
+
+        if not vectorize:
+            weight_slices = tf.split(weight, axis=0, num_or_size_splits=n_features)
+            output = []
+            for weight_slice in weight_slices:
+                feature_map = self.pa['conv_fun'](input_tensor,
+                                                  weight_slice,
+                                                  strides=self.pa['strides'],
+                                                  padding=self.pa['padding'],
+                                                  )
+                output.append(feature_map)
+            return tf.concat(output, axis=2)
+
+        # Stack the rows of weight along the output channels, so that the kernel with shape
+        # [1, n_features, in_channels, n_features * out_channels] computes all rows in one convolution
+        kernel = tf.reshape(tf.transpose(weight, perm=[1, 2, 0, 3]),
+                            shape=[1, n_features, in_channels, n_features * out_channels])
+        output = self.pa['conv_fun'](input_tensor,
+                                     kernel,
+                                     strides=self.pa['strides'],
+                                     padding=self.pa['padding'],
+                                     )
+
+        # Move the rows from channels to axis 2 as the concatenation of the feature maps of rows
+        height, width = output.shape.as_list()[1:3]
+        output = tf.reshape(output, shape=[-1, height, width, n_features, out_channels])
+        output = tf.reshape(tf.transpose(output, perm=[0, 1, 3, 2, 4]),
+                            shape=[-1, height, n_features * width, out_channels])
+        return output
+
     def call(self, input_tensor, output_tensor=None, training=True):
         return self.build(input_tensor=input_tensor,
                           output_tensor=output_tensor,
@@ -260,31 +337,33 @@ class EdgeToNodeWithGLasso(LayerObject):
                                  'conv_fun': tf.nn.conv2d,
                                  'padding': 'SAME',
                                  'scope': 'E2NGLasso',
+                                 'vectorize': True,
+                                 'share_covariance': True,
+                                 'rng': None,
+                                 'compute_dtype': None,
                                  })
         self.tensors = {}
 
         self.pa = self.set_parameters(arguments=arguments,
                                       parameters=parameters)
+        # The variables are kept in float32, the convolution is computed in the dtype of precision policy
+        self.compute_dtype = get_compute_dtype(self.pa['compute_dtype'])
 
         n_features, n_features, in_channels, out_channels = self.pa['kernel_shape']
         out_channels *= self.pa['n_class']
 
         initializer = self.get_initial_weight(kernel_shape=[n_features, n_features, in_channels, out_channels],
-                                              loc=0)
+                                              loc=0,
+                                              rng=self.pa['rng'])
         L = tf.Variable(dtype=tf.float32,
                         initial_value=initializer,
                         )
 
         # build weights
-        L_tril = tf.contrib.distributions.fill_triangular(L) + \
-                 tf.eye(num_rows=n_features,
-                        batch_shape=[in_channels, out_channels])
-        self.tensors['L'] = L_tril
-
-        self.weight_SICE = tf.transpose(a=tf.matmul(a=L_tril,
-                                                    b=tf.transpose(L_tril, perm=[0, 1, 3, 2]),
-                                                    name=self.pa['scope'] + 'weight_SICE'),
-                                        perm=[3, 2, 0, 1])
+        self.SICE = SICEParameterization(L=L, n_features=n_features, name=self.pa['scope'] + 'weight_SICE')
+        self.tensors['L'] = self.SICE.L_tril
+
+        self.weight_SICE = tf.transpose(a=self.SICE.weight, perm=[3, 2, 0, 1])
         self.tensors['weight_SICE'] = self.weight_SICE
 
         # # Weight initializer
@@ -329,11 +408,6 @@ class EdgeToNodeWithGLasso(LayerObject):
         # Since the weights are naturally symmetric, it does not need to transpose
         # weight = tf.transpose(weight, perm=[1, 0, 2, 3])
 
-        input_slices = tf.split(input_tensor, axis=1, num_or_size_splits=shape[1])
-        covariance_slices = tf.split(covariance_tensor, axis=1, num_or_size_splits=self.pa['kernel_shape'][0])
-        weight_SICE_slices = tf.split(self.weight_SICE, axis=0, num_or_size_splits=self.pa['kernel_shape'][0])
-
-        output = []
         if not ('SICE_training' in self.pa and not self.pa['SICE_training']):
             self.tensors['weight_SICE_bn'] = self.normalization(tensor=self.weight_SICE,
                                                                 axis=[0, 1],
@@ -341,37 +415,22 @@ class EdgeToNodeWithGLasso(LayerObject):
                                                                 off_diagonal=False)
             self.weight = tf.multiply(self.weight, self.tensors['weight_SICE_bn'] * 41)
             self.tensors['weight_multiply'] = self.weight
-        weight_slices = tf.split(self.weight, axis=0, num_or_size_splits=self.pa['kernel_shape'][0])
 
-        for input_slice, weight_slice, in zip(covariance_slices,
-                                              weight_slices,
-                                              ):
-            feature_map = self.pa['conv_fun'](input_slice,
-                                              weight_slice,
-                                              strides=self.pa['strides'],
-                                              padding=self.pa['padding'],
-                                              )
-            output.append(feature_map)
-        output = tf.concat(output, axis=1)
+        # The convolution and the sparse inverse covariance matrix regularization both read the covariance.
+        # The output is kept in the compute dtype and only the regularizer is computed in float32
+        output, output_SICE = self.convolution(covariance_tensor=covariance_tensor,
+                                               weights=[self.weight, self.weight_SICE],
+                                               vectorize=self.pa['vectorize'],
+                                               share_covariance=self.pa['share_covariance'])
         self.tensors['output_conv'] = output
 
         # Build sparse inverse covariance matrix regularization
-
-        output_SICE = []
-        for covariance_slice, weight_SICE_slice in zip(covariance_slices,
-                                                       weight_SICE_slices):
-            feature_map_SICE = self.pa['conv_fun'](covariance_slice,
-                                                   weight_SICE_slice,
-                                                   strides=self.pa['strides'],
-                                                   padding=self.pa['padding'],
-                                                   )
-            output_SICE.append(feature_map_SICE)
-        output_SICE = tf.concat(output_SICE, axis=1)
         self.tensors['output_SICE'] = output_SICE
 
         regularizer_results = build_SICE_regularizer(weight=weight,
                                                      L=self.tensors['L'],
-                                                     output=output_SICE)
+                                                     output=output_SICE,
+                                                     log_diagonal=self.SICE.log_diagonal)
         self.tensors.update(regularizer_results)
 
         # mean, var = tf.nn.moments(SICE_regularizer, axes=[1], keep_dims=True)
@@ -422,16 +481,16 @@ class EdgeToNodeWithGLasso(LayerObject):
 
         # bias
         if self.pa['bias']:
-            output = output + self.bias
+            output = output + cast(self.bias, self.compute_dtype)
             self.tensors['output_bias'] = output
 
-        # batch_normalization
+        # batch_normalization, whose statistics are computed in float32
         if self.pa['batch_normalization']:
-            output = self.batch_normalization(tensor=output,
+            output = self.batch_normalization(tensor=cast(output, tf.float32),
                                               scope=self.pa['scope'] + '/bn',
                                               training=training)
             self.tensors.update(output)
-            output = self.tensors['output_bn']
+            output = cast(self.tensors['output_bn'], self.compute_dtype)
 
         # activation
         if self.pa['activation']:
@@ -444,12 +503,73 @@ class EdgeToNodeWithGLasso(LayerObject):
     def call(self, input_tensor, output_tensor, covariance_tensor, training=True):
         return self.build(input_tensor, output_tensor, covariance_tensor, training=training)
 
+    def convolution(self,
+                    covariance_tensor,
+                    weights: list,
+                    vectorize: bool = True,
+                    share_covariance: bool = True,
+                    ) -> list:
+        """
+        Convolve each row of the covariance with the corresponding row of each weight.
+        :param covariance_tensor: The covariance with shape [batch_size, n_features, n_features, in_channels].
+        :param weights: The weights with shape [n_features, n_features, in_channels, out_channels].
+        :param vectorize: Compute all rows in a single batched matrix multiplication, otherwise convolve
+                          each row separately.
+        :param share_covariance: Contract the covariance with the concatenation of weights at once,
+                                 otherwise contract it with each weight separately.
+        :return: The list of feature maps with shape [batch_size, n_features, width, out_channels], in the
+                 compute dtype of layer.
+        """
+        n_features = self.pa['kernel_shape'][0]
+        covariance_tensor = cast(covariance_tensor, self.compute_dtype)
+        weights = [cast(weight, self.compute_dtype) for weight in weights]
+
+        if not vectorize:
+            covariance_slices = tf.split(covariance_tensor, axis=1, num_or_size_splits=n_features)
+            outputs = []
+            for weight in weights:
+                weight_slices = tf.split(weight, axis=0, num_or_size_splits=n_features)
+                output = []
+                for covariance_slice, weight_slice in zip(covariance_slices, weight_slices):
+                    feature_map = self.pa['conv_fun'](covariance_slice,
+                                                      weight_slice,
+                                                      strides=self.pa['strides'],
+                                                      padding=self.pa['padding'],
+                                                      )
+                    output.append(feature_map)
+                outputs.append(tf.concat(output, axis=1))
+            return outputs
+
+        if share_covariance:
+            out_channels = [weight.shape.as_list()[-1] for weight in weights]
+            output = row_wise_convolution(input_tensor=covariance_tensor,
+                                          weight=tf.concat(weights, axis=-1),
+                                          strides=self.pa['strides'],
+                                          padding=self.pa['padding'])
+            return tf.split(output, num_or_size_splits=out_channels, axis=-1)
+
+        return [row_wise_convolution(input_tensor=covariance_tensor,
+                                     weight=weight,
+                                     strides=self.pa['strides'],
+                                     padding=self.pa['padding'])
+                for weight in weights]
+
     def get_initial_weight(self,
                            kernel_shape: list,
                            mode: str = 'fan_in',
                            distribution: str = 'norm',
                            loc: float = 1,
+                           rng: np.random.Generator or int = None,
                            ):
+        """
+        Initialize the vector filled into the lower triangular factor of the SICE weight.
+        :param kernel_shape: The shape of kernel [n_features, n_features, in_channels, out_channels].
+        :param mode: The mode of scale, 'fan_in', 'fan_out' or 'fan_avg'.
+        :param distribution: The distribution of initial values, only support 'norm'.
+        :param loc: The mean of the initial values at diagonal.
+        :param rng: The random generator or seed, the global numpy random state by default.
+        :return: The initial vector with shape [in_channels, out_channels, n_features * (n_features + 1) / 2].
+        """
         rank = len(kernel_shape)
         assert rank in {2, 3, 4, 5}, 'The rank of kernel expected in {2, 3, 4, 5} but go {:d}'.format(rank)
         assert 'activation' in self.pa, 'The activation function must be given. '
@@ -475,22 +595,103 @@ class EdgeToNodeWithGLasso(LayerObject):
             raise TypeError('The distribution of EdgeToNodeWithGLasso only support norm')
 
         [size, _, in_channels, out_channels] = kernel_shape
-        tril_vec = np.zeros(shape=[in_channels, out_channels, int(size * (size + 1) / 2), ])
-        stddev = np.sqrt(stddev)
+        if rng is not None and not isinstance(rng, np.random.Generator):
+            rng = np.random.default_rng(rng)
+
+        return initial_tril_vector(size=size,
+                                   in_channels=in_channels,
+                                   out_channels=out_channels,
+                                   stddev=np.sqrt(stddev),
+                                   loc=loc,
+                                   rng=rng)
+
+
+def initial_tril_vector(size: int,
+                        in_channels: int,
+                        out_channels: int,
+                        stddev: float,
+                        loc: float = 1,
+                        rng: np.random.Generator = None,
+                        ) -> np.ndarray:
+    """
+    Sample the initial vector of lower triangular factors. For each i in [0, size / 2], the elements
+    i * size + i - 1 and i * size - 1 - size + i are sampled around 0, i * size and i * size - 1 around
+    loc, in this order, and the other elements are zeros.
+    :param size: The number of features.
+    :param in_channels: The number of input channels.
+    :param out_channels: The number of output channels.
+    :param stddev: The standard deviation of the sampled elements.
+    :param loc: The mean of the elements sampled around loc.
+    :param rng: The random generator, the global numpy random state by default.
+    :return: The initial vector with shape [in_channels, out_channels, size * (size + 1) / 2].
+    """
+    if rng is None:
+        rng = np.random
+    length = int(size * (size + 1) / 2)
 
-        for in_channel in range(in_channels):
-            for out_channel in range(out_channels):
-                for i in range(int(size / 2) + 1):
-                    tril_vec[in_channel, out_channel, i * size + i - 1] = np.random.normal(scale=stddev)
-                    tril_vec[in_channel, out_channel, i * size] = np.random.normal(loc=loc, scale=stddev)
-                    tril_vec[in_channel, out_channel, i * size - 1] = np.random.normal(loc=loc, scale=stddev)
-                    tril_vec[in_channel, out_channel, i * size - 1 - size + i] = np.random.normal(scale=stddev)
+    i = np.arange(int(size / 2) + 1)[:, np.newaxis]
+    indexes = np.concatenate((i * size + i - 1, i * size, i * size - 1, i * size - 1 - size + i), axis=1)
+    locs = np.tile([0, loc, loc, 0], reps=[len(i), 1])
 
-        return tril_vec
+    # Negative indexes count from the end, and the last assignment of an index wins
+    indexes = np.mod(indexes.flatten(), length)[::-1]
+    indexes, first = np.unique(indexes, return_index=True)
+    locs = locs.flatten()[::-1][first]
 
+    tril_vec = np.zeros(shape=[in_channels, out_channels, length])
+    tril_vec[..., indexes] = rng.normal(loc=locs, scale=stddev, size=[in_channels, out_channels, len(indexes)])
+    return tril_vec
 
-def build_SICE_regularizer(weight, L, output):
-    logdet = -tf.reduce_sum(tf.log(tf.square(tf.matrix_diag_part(L))), axis=(0, 2))
+
+def row_wise_convolution(input_tensor, weight, strides: list, padding: str):
+    """
+    Convolve each row of input with the corresponding row of weight as a batched matrix multiplication,
+    which is equivalent to concatenating the 2D convolutions of rows along axis 1.
+    :param input_tensor: The input with shape [batch_size, n_features, width, in_channels].
+    :param weight: The weight with shape [n_features, kernel_width, in_channels, out_channels].
+    :param strides: The strides of the 2D convolutions.
+    :param padding: The padding of the 2D convolutions.
+    :return: The feature maps with shape [batch_size, n_features, output_width, out_channels].
+    """
+    n_features, width, in_channels = input_tensor.shape.as_list()[1:]
+    _, kernel_width, _, out_channels = weight.shape.as_list()
+
+    if padding == 'VALID' and kernel_width == width:
+        # Each row is a single patch
+        patches = tf.reshape(input_tensor, shape=[-1, n_features, 1, width * in_channels])
+    else:
+        # A row only convolves with itself, so the rows are never strided
+        patches = tf.extract_image_patches(input_tensor,
+                                           ksizes=[1, 1, kernel_width, 1],
+                                           strides=[1, 1, strides[2], 1],
+                                           rates=[1, 1, 1, 1],
+                                           padding=padding)
+    output_width = patches.shape.as_list()[2]
+
+    # [n_features, batch_size * output_width, kernel_width * in_channels]
+    patches = tf.reshape(tf.transpose(patches, perm=[1, 0, 2, 3]),
+                         shape=[n_features, -1, kernel_width * in_channels])
+    # [n_features, kernel_width * in_channels, out_channels]
+    kernel = tf.reshape(weight, shape=[n_features, kernel_width * in_channels, out_channels])
+
+    output = tf.reshape(tf.matmul(patches, kernel), shape=[n_features, -1, output_width, out_channels])
+    return tf.transpose(output, perm=[1, 0, 2, 3])
+
+
+def build_SICE_regularizer(weight, L, output, log_diagonal=None):
+    """
+    Build the terms of sparse inverse covariance estimation.
+    :param weight: The SICE weight with shape [n_features, n_features, in_channels, out_channels].
+    :param L: The lower triangular factor of weight with shape [in_channels, out_channels, n_features, n_features].
+    :param output: The convolution of the covariance with weight.
+    :param log_diagonal: The log of squared diagonal of L, computed from L if not given.
+    :return: Dictionary of the log determinant, 1-norm and trace, which are computed in float32
+             whatever the precision policy.
+    """
+    weight, L, output = [cast(tensor, tf.float32) for tensor in [weight, L, output]]
+    if log_diagonal is None:
+        log_diagonal = tf.log(tf.square(tf.matrix_diag_part(L)))
+    logdet = -tf.reduce_sum(log_diagonal, axis=(0, 2))
     # trace = tf.trace(tf.transpose(output, perm=[0, 3, 1, 2]))
     trace = tf.reduce_sum(output, axis=(1, 2))
     norm_1 = tf.reduce_sum(input_tensor=tf.abs(weight), axis=(0, 1, 2))
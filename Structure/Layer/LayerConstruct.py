@@ -8,6 +8,52 @@ from Structure.Layer.CNNElementWise import EdgeToNodeElementWise
 from Structure.Layer.CNNWithGLasso import EdgeToEdgeWithGLasso, EdgeToNodeWithGLasso, EdgeToNodeWithGLassoTest
 from Structure.Layer.GraphNN import GraphConnected
 from Structure.Layer.GraphCNN import GraphCNN
+from Structure.precision import cast
+
+
+# The layers computing in the dtype of precision policy
+precision_layers = ['EdgeToEdgeWithGLasso', 'EdgeToNodeWithGLasso']
+
+
+def set_compute_dtype(parameters, compute_dtype):
+    """
+    Set the compute dtype of the layers supporting precision policy in the structure parameters, such as
+    the parameters of autoencoders parsed from scheme, before the layers are built by build_layer.
+    :param parameters: The nested dictionaries and lists of layer arguments.
+    :param compute_dtype: The compute dtype, such as the compute dtype of precision policy.
+    :return: The number of layers set.
+    """
+    if isinstance(parameters, (list, tuple)):
+        return sum([set_compute_dtype(item, compute_dtype) for item in parameters])
+    if not isinstance(parameters, dict):
+        return 0
+    if parameters.get('type') in precision_layers:
+        parameters['compute_dtype'] = compute_dtype
+        return 1
+    return sum([set_compute_dtype(value, compute_dtype) for value in parameters.values()])
+
+
+def cast_inputs(layer, dtype: tf.DType = tf.float32):
+    """
+    Cast the floating input tensors of layer to dtype when the layer is built, so that the layers with
+    float32 variables accept the outputs of the layers computing in the dtype of precision policy.
+    :param layer: The layer to be wrapped.
+    :param dtype: The dtype of the variables of layer.
+    :return: The layer.
+    """
+    if not hasattr(layer, 'build'):
+        return layer
+
+    build = layer.build
+
+    def build_with_cast(*args, **kwargs):
+        args = [cast(arg, dtype) if isinstance(arg, tf.Tensor) else arg for arg in args]
+        kwargs = {key: cast(value, dtype) if isinstance(value, tf.Tensor) else value
+                  for key, value in kwargs.items()}
+        return build(*args, **kwargs)
+
+    layer.build = build_with_cast
+    return layer
 
 
 def build_layer(arguments, parameters=None):
@@ -107,4 +153,7 @@ def build_layer(arguments, parameters=None):
     else:
         raise TypeError('Cannot build layer with type of {:s}'.format(type))
 
+    # The inputs from the layers of precision policy may be in float16 or bfloat16
+    if type not in precision_layers:
+        layer = cast_inputs(layer)
     return layer
@@ -0,0 +1,219 @@
+import hashlib
+import json
+import os
+import sys
+import tempfile
+
+import h5py
+import numpy as np
+
+from Structure.dataset import HDF5Dataset
+
+
+class ActivationCache:
+    """
+    Cache the outputs of the frozen encoder prefix during greedy layer-wise pre-training.
+    The activations of a prefix are computed once per fold and kept in memory, or in a
+    memory-mapped scratch file if they are larger than the memory limit.
+    """
+
+    def __init__(self, memory_limit: int = 2 ** 31, scratch_dir: str = None):
+        """
+        :param memory_limit: The maximum bytes of activations kept in memory.
+        :param scratch_dir: The directory of the scratch files, the system temporary directory by default.
+        """
+        self.memory_limit = memory_limit
+        self.scratch_dir = scratch_dir
+        self.activations = dict()
+        self.scratch_files = dict()
+
+    def get(self, prefix: int, data, encode, batch_size: int) -> np.ndarray:
+        """
+        Get the activations of the frozen prefix, compute them if not cached.
+        :param prefix: The number of frozen autoencoders.
+        :param data: The input data of the prefix.
+        :param encode: Function maps a batch of data to the output of the prefix.
+        :param batch_size: The batch size to compute the activations.
+        :return: The activations with the same number of samples as data.
+        """
+        if prefix not in self.activations:
+            self.activations[prefix] = self.compute(prefix=prefix,
+                                                    data=data,
+                                                    encode=encode,
+                                                    batch_size=batch_size)
+        return self.activations[prefix]
+
+    def compute(self, prefix: int, data, encode, batch_size: int) -> np.ndarray:
+        data_size = np.size(data, 0)
+        activations = None
+
+        steps = (data_size - 1) // batch_size + 1
+        for step in range(steps):
+            start = step * batch_size
+            stop = min(start + batch_size, data_size)
+            batch = np.asarray(encode(data[start:stop]))
+            if activations is None:
+                activations = self.allocate(prefix=prefix,
+                                            shape=[data_size] + list(np.shape(batch)[1:]),
+                                            dtype=batch.dtype)
+            activations[start:stop] = batch
+            msg = '\rCaching activations of {:d} frozen autoencoders {:3d} of {:3d}'.format(prefix, step + 1, steps)
+            sys.stdout.write(msg)
+        print()
+
+        if isinstance(activations, np.memmap):
+            activations.flush()
+        return activations
+
+    def allocate(self, prefix: int, shape: list, dtype) -> np.ndarray:
+        nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        if nbytes <= self.memory_limit:
+            return np.empty(shape=shape, dtype=dtype)
+
+        file_descriptor, file_path = tempfile.mkstemp(prefix='activations_{:d}_'.format(prefix),
+                                                      suffix='.dat',
+                                                      dir=self.scratch_dir)
+        os.close(file_descriptor)
+        self.scratch_files[prefix] = file_path
+        return np.memmap(file_path, dtype=dtype, mode='w+', shape=tuple(shape))
+
+    def invalidate(self, start: int = 0):
+        """
+        Drop the activations of prefixes containing the autoencoder with index start or later,
+        which is required once these autoencoders have been trained.
+        :param start: The index of the first changed autoencoder.
+        """
+        for prefix in [p for p in self.activations if p > start]:
+            del self.activations[prefix]
+            file_path = self.scratch_files.pop(prefix, None)
+            if file_path and os.path.exists(file_path):
+                os.remove(file_path)
+
+    def reset(self):
+        self.invalidate(start=-1)
+
+
+class FoldCache:
+    """
+    Materialize the datasets of folds once into uncompressed .npy files, which are served as read-only
+    memory maps. Repeated runs and parallel workers then share one copy in the page cache instead of
+    decompressing the hdf5 file again. A cached file is valid while the dataset keeps its fingerprint, see
+    get_source, so that writing other datasets of the file, such as the outputs of encode_fold, keeps the cache.
+    The datasets of folds are treated as immutable: a dataset rewritten by deleting and creating it again is
+    detected, as is a change of its first or last block, but not a change in place of the rows between.
+    """
+
+    # The data of .npy files starts at a page boundary
+    alignment = 4096
+
+    def __init__(self, cache_dir: str):
+        """
+        :param cache_dir: The directory of cached files, shared by runs and workers.
+        """
+        self.cache_dir = cache_dir
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+    def get(self, dataset: h5py.Dataset) -> np.ndarray:
+        """
+        The memory map of dataset, which is materialized if not cached or invalid.
+        """
+        source = self.get_source(dataset)
+        key = hashlib.sha1('{:s}:{:s}'.format(source['file'], source['name']).encode()).hexdigest()
+        cache_path = os.path.join(self.cache_dir, '{:s}.npy'.format(key))
+        meta_path = os.path.join(self.cache_dir, '{:s}.json'.format(key))
+
+        if not self.is_valid(cache_path=cache_path, meta_path=meta_path, source=source):
+            self.materialize(dataset=dataset, cache_path=cache_path, meta_path=meta_path, source=source)
+        return np.load(cache_path, mmap_mode='r')
+
+    @staticmethod
+    def get_source(dataset: h5py.Dataset) -> dict:
+        """
+        The fingerprint of dataset, which is its name, shape, dtype and layout, the addresses of its header
+        and storage in file, and the digest of its first and last blocks.
+        """
+        data = HDF5Dataset(dataset, dtype=dataset.dtype)
+        digest = hashlib.sha1()
+        for start in sorted(set([0, max(0, len(data) - data.block_size)])) if len(data) else []:
+            digest.update(np.ascontiguousarray(data[start: start + data.block_size]).tobytes())
+        return {'file': os.path.abspath(dataset.file.filename),
+                'name': dataset.name,
+                'shape': list(dataset.shape),
+                'dtype': dataset.dtype.str,
+                'chunks': list(dataset.chunks) if dataset.chunks else None,
+                'compression': dataset.compression,
+                'address': h5py.h5o.get_info(dataset.id).addr,
+                'offset': dataset.id.get_offset(),
+                'digest': digest.hexdigest(),
+                }
+
+    @staticmethod
+    def is_valid(cache_path: str, meta_path: str, source: dict) -> bool:
+        if not os.path.exists(cache_path) or not os.path.exists(meta_path):
+            return False
+        try:
+            with open(meta_path, 'r') as file:
+                return json.load(file) == source
+        except ValueError:
+            return False
+
+    def materialize(self, dataset: h5py.Dataset, cache_path: str, meta_path: str, source: dict):
+        data = HDF5Dataset(dataset, dtype=dataset.dtype)
+
+        # Write to a temporary file renamed once complete, so that concurrent workers never read a partial file
+        file_descriptor, temp_path = tempfile.mkstemp(suffix='.tmp', dir=self.cache_dir)
+        try:
+            with os.fdopen(file_descriptor, 'wb') as file:
+                file.write(self.get_header(shape=dataset.shape, dtype=dataset.dtype))
+                steps = (len(data) - 1) // data.block_size + 1 if len(data) else 0
+                for step in range(steps):
+                    block = data[step * data.block_size: (step + 1) * data.block_size]
+                    file.write(np.ascontiguousarray(block, dtype=dataset.dtype).tobytes())
+                    msg = '\rCaching {:s} {:3d} of {:3d}'.format(source['name'], step + 1, steps)
+                    sys.stdout.write(msg)
+            os.replace(temp_path, cache_path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        print()
+
+        with open(meta_path + '.tmp', 'w') as file:
+            json.dump(source, file)
+        os.replace(meta_path + '.tmp', meta_path)
+
+    def get_header(self, shape: tuple, dtype: np.dtype) -> bytes:
+        """
+        The header of .npy format 1.0, padded with spaces to a multiple of the alignment.
+        """
+        header = repr({'descr': np.lib.format.dtype_to_descr(np.dtype(dtype)),
+                       'fortran_order': False,
+                       'shape': tuple(shape),
+                       })
+        # The magic string, version and header length take 10 bytes, and the header ends with a newline
+        length = -(-(10 + len(header) + 1) // self.alignment) * self.alignment
+        header = header + ' ' * (length - 10 - len(header) - 1) + '\n'
+        return b'\x93NUMPY' + bytes([1, 0]) + np.uint16(len(header)).tobytes() + header.encode('latin1')
+
+
+# The fold cache of current process, set by set_fold_cache
+fold_cache = None
+
+
+def set_fold_cache(cache_dir: str = None) -> FoldCache:
+    """
+    Serve the datasets of folds from the fold cache in cache_dir, or directly from hdf5 file if None.
+    """
+    global fold_cache
+    fold_cache = FoldCache(cache_dir=cache_dir) if cache_dir else None
+    return fold_cache
+
+
+def load_dataset(dataset: h5py.Dataset):
+    """
+    The dataset of fold, served by the fold cache if set, otherwise streamed from hdf5 file.
+    """
+    if fold_cache is not None:
+        return fold_cache.get(dataset)
+    return HDF5Dataset(dataset)
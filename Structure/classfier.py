@@ -5,6 +5,9 @@ from Structure.Layer import *
 from data.utils_prepare_data import *
 from Structure.Schemes.xml_parse import *
 from abc import ABCMeta
+from Structure.dataset import HDF5Dataset
+from Structure.label import format_labels, format_samples
+from Structure.scheduler import FoldScheduler
 
 
 class Classifier(object, metaclass=ABCMeta):
@@ -22,37 +25,41 @@ class Classifier(object, metaclass=ABCMeta):
 
 class SupportVectorMachine(Classifier):
 
-    def __init__(self):
+    def __init__(self, C: float = 1.0, linear: bool = False):
+        """
+        :param C: The regularization parameter, the smaller the stronger regularization.
+        :param linear: Use LinearSVC (liblinear) instead of SVC with linear kernel (libsvm), which is much
+                       faster on high-dimensional features but minimizes the squared hinge loss by default.
+        """
         Classifier.__init__(self)
-        self.clf = svm.SVC(kernel='linear')
-
-    def run(self, data):
+        if linear:
+            self.clf = svm.LinearSVC(C=C)
+        else:
+            self.clf = svm.SVC(kernel='linear', C=C)
+
+    def run(self, data) -> dict:
+        """
+        Fit on the train data and evaluate on each split.
+        :param data: Dictionary of the data and label of train, valid and test.
+        :return: Dictionary maps split to its accuracy.
+        """
         self.check_data_format(data)
 
         self.clf.fit(data['train data'], data['train label'])
-        predict_train = self.clf.predict(data['train data'])
-        train = np.array([predict_train, data['train label']])
-        mse_train = self.clf.score(data['train data'], data['train label'])
-        predict_valid = self.clf.predict(data['valid data'])
-        valid = np.array([predict_valid, data['valid label']])
-        mse_valid = self.clf.score(data['valid data'], data['valid label'])
-        predict_test = self.clf.predict(data['test data'])
-        test = np.array([predict_test, data['test label']])
-        mse_test = self.clf.score(data['test data'], data['test label'])
-        print('Train: {:5e}    Valid: {:5e}    Test: {:5e}'.format(mse_train, mse_valid, mse_test))
-
-    def check_data_format(self, data):
+        results = dict()
         for tvt in ['train', 'valid', 'test']:
-            # Data
-            tvt_flag = '{:s} data'.format(tvt)
-            shape = np.shape(data[tvt_flag])
-            data[tvt_flag] = np.reshape(data[tvt_flag], newshape=[shape[0], -1])
+            # Predict once and score by the predictions
+            predict = self.clf.predict(data['{:s} data'.format(tvt)])
+            results[tvt] = np.mean(predict == data['{:s} label'.format(tvt)])
+        print('Train: {:5e}    Valid: {:5e}    Test: {:5e}'.format(results['train'], results['valid'], results['test']))
+        return results
 
-            # Label
-            tvt_flag = '{:s} label'.format(tvt)
-            shape = np.shape(data[tvt_flag])
-            if len(shape) == 2:
-                data[tvt_flag] = onehot_to_vector(data[tvt_flag])
+    @staticmethod
+    def check_data_format(data):
+        # The label conversions are memoized, repeated runs on the same fold skip them
+        for tvt in ['train', 'valid', 'test']:
+            data['{:s} data'.format(tvt)] = format_samples(data['{:s} data'.format(tvt)])
+            data['{:s} label'.format(tvt)] = format_labels(data['{:s} label'.format(tvt)])
 
 
 def ann_classify(folds: h5py.Group = None):
@@ -69,11 +76,11 @@ def ann_classify(folds: h5py.Group = None):
         for tvt in ['train', 'valid', 'test']:
             for flag in ['data', 'label']:
                 tvt_flag = '{:s} {:s} encoder'.format(tvt, flag)
-                data_tmp = np.array(fold[tvt_flag])
-                shape = np.shape(data_tmp)
-
-                data_tmp = np.array(fold[tvt_flag])
-                data[tvt_flag] = data_tmp
+                # Labels are small, the data is read from the file on demand
+                if flag == 'data':
+                    data[tvt_flag] = HDF5Dataset(fold[tvt_flag])
+                else:
+                    data[tvt_flag] = np.array(fold[tvt_flag])
 
         # Set Graph
         graph = tf.Graph()
@@ -83,12 +90,59 @@ def ann_classify(folds: h5py.Group = None):
         ann.backpropagation(data=data)
 
 
-def svm_classify(datas=None, folds=None, data_flag='data encoder'):
-    svm_classifier = SupportVectorMachine()
+def svm_fold(job: tuple, data: dict, linear: bool = False) -> dict:
+    """
+    Run a SupportVectorMachine on one fold with one regularization parameter.
+    :param job: Tuple of (fold index, C).
+    :param data: The data of fold.
+    :param linear: Use LinearSVC.
+    :return: Dictionary maps split to its accuracy.
+    """
+    fold_index, C = job
+    return SupportVectorMachine(C=C, linear=linear).run(data)
+
+
+def svm_classify(datas=None,
+                 folds=None,
+                 data_flag='data encoder',
+                 Cs: list = None,
+                 linear: bool = False,
+                 workers: int = 1,
+                 ) -> np.ndarray:
+    """
+    Evaluate SupportVectorMachine on each fold with each regularization parameter.
+    :param datas: The list of the data of folds, prepared from folds if None.
+    :param folds: The folds of data.
+    :param data_flag: The flag of data in folds.
+    :param Cs: The regularization parameters to be swept, [1.0] by default.
+    :param linear: Use LinearSVC (liblinear), which suits high-dimensional encoder features.
+    :param workers: The number of processes running the (fold, C) jobs.
+    :return: Structured array with the fold, C and the accuracy of train, valid and test of each job.
+    """
+    if Cs is None:
+        Cs = [1.0]
     if datas is None:
         datas = prepare_classify_data(folds=folds, data_flag=data_flag)
+
+    # Convert the data once in current process, the workers receive plain arrays
+    datas = list(datas)
     for data in datas:
-        svm_classifier.run(data)
+        SupportVectorMachine.check_data_format(data)
+
+    jobs = [(fold_index, C) for fold_index in range(len(datas)) for C in Cs]
+    job_kwargs = {job: {'data': datas[job[0]]} for job in jobs}
+    scheduler = FoldScheduler(workers=workers, intra_op_threads=1, maxtasksperchild=None)
+    results = scheduler.run(svm_fold, jobs=jobs, job_kwargs=job_kwargs, linear=linear)
+
+    table = np.zeros(shape=[len(jobs)], dtype=[('fold', int),
+                                               ('C', float),
+                                               ('train', float),
+                                               ('valid', float),
+                                               ('test', float),
+                                               ])
+    for index, job in enumerate(jobs):
+        table[index] = (job[0], job[1], results[job]['train'], results[job]['valid'], results[job]['test'])
+    return table
 
 
 def cnn_classify(datas=None, folds=None):
@@ -0,0 +1,98 @@
+import numpy as np
+
+
+class TrainingController:
+    """
+    Decide when to validate and when to stop training. Training stops once the validation MSE has not
+    improved for patience epochs. With adaptive evaluation, the interval between validations doubles
+    after each improvement up to max_test_cycle, and falls back to test_cycle once the improvement stalls,
+    so that the plateau is detected promptly while few validations are run during steady descent. The
+    interval never exceeds patience, otherwise a single stalled validation would stop training.
+    """
+
+    def __init__(self,
+                 training_cycle: int,
+                 test_cycle: int,
+                 patience: int = None,
+                 min_delta: float = 0,
+                 adaptive: bool = False,
+                 max_test_cycle: int = None,
+                 start_epoch: int = 0,
+                 ):
+        """
+        :param training_cycle: The maximum number of epochs.
+        :param test_cycle: The number of epochs between validations.
+        :param patience: The number of epochs without improvement before stopping, None never stops early.
+        :param min_delta: The minimum decrease of validation MSE counted as improvement.
+        :param adaptive: Adapt the number of epochs between validations.
+        :param max_test_cycle: The maximum number of epochs between validations, 4 * test_cycle by default.
+        :param start_epoch: The epoch training starts from.
+        """
+        self.training_cycle = training_cycle
+        self.test_cycle = test_cycle
+        self.patience = patience
+        self.min_delta = min_delta
+        self.adaptive = adaptive
+        self.max_test_cycle = max_test_cycle if max_test_cycle else 4 * test_cycle
+        if patience is not None:
+            self.max_test_cycle = max(min(self.max_test_cycle, patience), test_cycle)
+
+        self.cycle = test_cycle
+        self.last_validation = start_epoch
+        self.best_mse = np.inf
+        self.best_epoch = start_epoch
+        self.stop = False
+
+    @classmethod
+    def from_parameters(cls, train_pa: dict, start_epoch: int = 0):
+        """
+        Build the controller from the training parameters, the keys other than 'training_cycle' and
+        'test_cycle' are optional.
+        """
+        return cls(training_cycle=train_pa['training_cycle'],
+                   test_cycle=train_pa['test_cycle'],
+                   patience=train_pa.get('patience'),
+                   min_delta=train_pa.get('min_delta', 0),
+                   adaptive=train_pa.get('adaptive_test_cycle', False),
+                   max_test_cycle=train_pa.get('max_test_cycle'),
+                   start_epoch=start_epoch,
+                   )
+
+    def should_validate(self, epoch: int) -> bool:
+        """
+        Whether to validate after the epoch (counted from 0).
+        """
+        return epoch + 1 - self.last_validation >= self.cycle or epoch + 1 >= self.training_cycle
+
+    def update(self, epoch: int, valid_mse: float) -> bool:
+        """
+        Record the validation MSE after the epoch.
+        :return: Whether the validation MSE improved.
+        """
+        self.last_validation = epoch + 1
+        improved = valid_mse < self.best_mse - self.min_delta
+        if improved:
+            self.best_mse = valid_mse
+            self.best_epoch = epoch + 1
+
+        if self.adaptive:
+            self.cycle = min(self.cycle * 2, self.max_test_cycle) if improved else self.test_cycle
+
+        if self.patience is not None and epoch + 1 - self.best_epoch >= self.patience:
+            self.stop = True
+        return improved
+
+
+def subsample(data, samples: int = None, seed: int = 0):
+    """
+    A fixed random subset of data, so that the validation MSE of each epoch is comparable.
+    :param data: The data with samples along the first axis, np.ndarray or HDF5Dataset.
+    :param samples: The number of samples, all data if None or not less than the size of data.
+    :param seed: The seed of subset.
+    :return: The subset of data.
+    """
+    data_size = np.size(data, 0)
+    if samples is None or samples >= data_size:
+        return data
+    indexes = np.sort(np.random.RandomState(seed).choice(data_size, size=samples, replace=False))
+    return data[indexes]
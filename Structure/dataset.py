@@ -0,0 +1,272 @@
+import queue
+import threading
+
+import h5py
+import numpy as np
+
+from Log.profiler import profiler
+
+
+class HDF5Dataset:
+    """
+    Streaming view of a dataset in a fold of the hdf5 file. Samples are read from the file on demand
+    instead of loading the whole dataset into memory.
+    """
+
+    def __init__(self,
+                 dataset: h5py.Dataset,
+                 dtype=np.float32,
+                 prefetch: int = 2,
+                 buffer_size: int = 1024,
+                 block_bytes: int = 2 ** 20,
+                 ):
+        """
+        :param dataset: The dataset in hdf5 file with samples along the first axis.
+        :param dtype: The data type of returned samples.
+        :param prefetch: The maximum number of batches read ahead in background.
+        :param buffer_size: The minimum number of samples shuffled together when yielding shuffled batches.
+        :param block_bytes: The approximate bytes of a block read from a contiguous (unchunked) dataset.
+        """
+        self.dataset = dataset
+        self.dtype = dtype
+        self.prefetch = prefetch
+        self.buffer_size = buffer_size
+
+        # Read blocks aligned with the chunks of dataset, so that each chunk is read once per epoch.
+        # A contiguous dataset is read in blocks of about block_bytes.
+        if dataset.chunks:
+            self.block_size = dataset.chunks[0]
+        else:
+            sample_bytes = int(np.prod(dataset.shape[1:])) * dataset.dtype.itemsize
+            self.block_size = max(1, block_bytes // max(1, sample_bytes))
+
+    @property
+    def shape(self):
+        return self.dataset.shape
+
+    def __len__(self):
+        return self.dataset.shape[0]
+
+    def __getitem__(self, index):
+        if isinstance(index, (list, np.ndarray)):
+            # hdf5 only supports increasing indexes, read the sorted samples and restore the order
+            index = np.asarray(index)
+            if index.dtype == bool:
+                index = np.flatnonzero(index)
+            unique_index, inverse = np.unique(index, return_inverse=True)
+            return np.asarray(self.dataset[unique_index], dtype=self.dtype)[inverse]
+        return np.asarray(self.dataset[index], dtype=self.dtype)
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray(self.dataset[()], dtype=dtype if dtype else self.dtype)
+
+    def batches(self, batch_size: int, shuffle: bool = True):
+        """
+        Yield mini-batches of the dataset, which are read in background.
+        :param batch_size: The number of samples in a batch.
+        :param shuffle: Shuffle the order of samples.
+        :return: Generator of batches with type of np.ndarray.
+        """
+        return prefetch(self.read_batches(batch_size=batch_size, shuffle=shuffle), depth=self.prefetch)
+
+    def read_batches(self, batch_size: int, shuffle: bool = True):
+        data_size = len(self)
+        block_starts = np.arange(start=0, stop=data_size, step=self.block_size)
+        if shuffle:
+            block_starts = np.random.permutation(block_starts)
+
+        # The number of blocks shuffled together
+        blocks_per_buffer = max(1, -(-max(self.buffer_size, batch_size) // self.block_size))
+
+        remainder = None
+        for buffer_start in range(0, len(block_starts), blocks_per_buffer):
+            with profiler.phase('data load'):
+                blocks = [self.dataset[start: start + self.block_size]
+                          for start in sorted(block_starts[buffer_start: buffer_start + blocks_per_buffer])]
+                if remainder is not None:
+                    blocks.insert(0, remainder)
+                buffer = np.asarray(np.concatenate(blocks, axis=0), dtype=self.dtype)
+            if shuffle:
+                with profiler.phase('shuffle'):
+                    buffer = buffer[np.random.permutation(len(buffer))]
+
+            batch_num = len(buffer) // batch_size
+            for batch_index in range(batch_num):
+                yield buffer[batch_index * batch_size: (batch_index + 1) * batch_size]
+            remainder = buffer[batch_num * batch_size:]
+
+        if remainder is not None and len(remainder) > 0:
+            yield remainder
+
+
+def iterate_batches(data,
+                    batch_size: int,
+                    shuffle: bool = True,
+                    depth: int = 0,
+                    dtype=np.float32,
+                    shape: list = None,
+                    ):
+    """
+    Yield mini-batches of data, which is either np.ndarray or HDF5Dataset. The batches are
+    gathered, reshaped and cast in a background thread while the current batch is consumed.
+    :param data: The data with samples along the first axis.
+    :param batch_size: The number of samples in a batch.
+    :param shuffle: Shuffle the order of samples.
+    :param depth: The maximum number of batches prepared ahead, 0 prepares the batches in the caller thread.
+    :param dtype: The data type of batches.
+    :param shape: The shape of a sample in batches.
+    :return: Generator of batches with type of np.ndarray.
+    """
+    return prefetch(prepare_batches(data=data,
+                                    batch_size=batch_size,
+                                    shuffle=shuffle,
+                                    dtype=dtype,
+                                    shape=shape),
+                    depth=depth)
+
+
+def prepare_batches(data, batch_size: int, shuffle: bool = True, dtype=np.float32, shape: list = None):
+    if isinstance(data, HDF5Dataset):
+        batches = data.read_batches(batch_size=batch_size, shuffle=shuffle)
+    else:
+        batches = gather_batches(data=data, batch_size=batch_size, shuffle=shuffle)
+
+    for batch in batches:
+        batch = np.asarray(batch, dtype=dtype)
+        if shape is not None:
+            batch = np.reshape(batch, [-1] + list(shape))
+        yield batch
+
+
+def gather_batches(data, batch_size: int, shuffle: bool = True):
+    data_size = np.size(data, axis=0)
+    steps = (data_size - 1) // batch_size + 1
+    if not shuffle:
+        for step in range(steps):
+            yield data[step * batch_size: (step + 1) * batch_size]
+        return
+
+    # Gather each batch from the permutation instead of copying the whole shuffled data,
+    # the sorted indexes keep the reads sequential for memory-mapped data
+    with profiler.phase('shuffle'):
+        random_index = np.random.permutation(data_size)
+    for step in range(steps):
+        with profiler.phase('data load'):
+            batch = data[np.sort(random_index[step * batch_size: (step + 1) * batch_size])]
+        yield batch
+
+
+def prefetch(iterable, depth: int = 2):
+    """
+    Iterate the iterable in a background thread, at most depth items are buffered ahead.
+    """
+    if depth <= 0:
+        for item in iterable:
+            yield item
+        return
+
+    buffer = queue.Queue(maxsize=depth)
+    stop_event = threading.Event()
+    end = object()
+
+    def put(item) -> bool:
+        # Give up once the consumer stops iterating
+        while not stop_event.is_set():
+            try:
+                buffer.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for produced in iterable:
+                if not put((produced, None)):
+                    return
+            put((end, None))
+        except Exception as e:
+            put((end, e))
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    try:
+        while True:
+            item, error = buffer.get()
+            if item is end:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        stop_event.set()
+
+
+class HDF5Writer:
+    """
+    Write a dataset to hdf5 file batch by batch. The dataset is resizable and chunked along the first axis,
+    and optionally compressed.
+    """
+
+    def __init__(self,
+                 group: h5py.Group,
+                 name: str,
+                 rows_per_item: int = None,
+                 dtype=np.float32,
+                 chunk_bytes: int = 2 ** 20,
+                 compression: str = None,
+                 ):
+        """
+        :param group: The group of dataset, the existing dataset with the same name is replaced.
+        :param name: The name of dataset.
+        :param rows_per_item: Group every rows_per_item consecutive rows into an item of the dataset.
+        :param dtype: The data type of dataset.
+        :param chunk_bytes: The approximate bytes of a chunk.
+        :param compression: The compression filter such as 'lzf' or 'gzip', None for no compression.
+        """
+        self.group = group
+        self.name = name
+        self.rows_per_item = rows_per_item
+        self.dtype = dtype
+        self.chunk_bytes = chunk_bytes
+        self.compression = compression
+
+        self.dataset = None
+        self.remainder = None
+
+    def append(self, batch: np.ndarray):
+        batch = np.asarray(batch, dtype=self.dtype)
+        if self.rows_per_item:
+            if self.remainder is not None:
+                batch = np.concatenate((self.remainder, batch), axis=0)
+            rows = len(batch) // self.rows_per_item * self.rows_per_item
+            self.remainder = batch[rows:]
+            batch = np.reshape(batch[:rows], [-1, self.rows_per_item] + list(np.shape(batch)[1:]))
+
+        if self.dataset is None:
+            self.create(item_shape=list(np.shape(batch)[1:]))
+        if len(batch) == 0:
+            return
+
+        size = self.dataset.shape[0]
+        self.dataset.resize(size + len(batch), axis=0)
+        self.dataset[size:] = batch
+
+    def create(self, item_shape: list):
+        if self.name in self.group:
+            del self.group[self.name]
+
+        item_bytes = int(np.prod(item_shape)) * np.dtype(self.dtype).itemsize
+        chunk_rows = max(1, self.chunk_bytes // max(1, item_bytes))
+        self.dataset = self.group.create_dataset(name=self.name,
+                                                 shape=tuple([0] + item_shape),
+                                                 maxshape=tuple([None] + item_shape),
+                                                 chunks=tuple([chunk_rows] + item_shape),
+                                                 dtype=self.dtype,
+                                                 compression=self.compression,
+                                                 )
+
+    def close(self):
+        if self.remainder is not None and len(self.remainder) > 0:
+            raise ValueError('{:d} rows of {:s} cannot be grouped into items of {:d} rows.'.format(
+                len(self.remainder), self.name, self.rows_per_item))
@@ -0,0 +1,140 @@
+import json
+import os
+
+import numpy as np
+import tensorflow as tf
+
+
+def export_frozen_graph(sess: tf.Session,
+                        inputs: dict,
+                        outputs: dict,
+                        export_dir: str,
+                        name: str = 'encoder',
+                        defaults: dict = None,
+                        ):
+    """
+    Export the subgraph computing outputs from inputs, with the variables folded into constants.
+    The graph is written to '{name}.pb' and the names of its inputs and outputs to '{name}.json',
+    so that it is loaded without the scheme files.
+    :param sess: The session holding the values of variables.
+    :param inputs: Dictionary maps name to the input placeholder.
+    :param outputs: Dictionary maps name to the output tensor.
+    :param export_dir: The directory of exported files.
+    :param name: The name of exported files.
+    :param defaults: Dictionary maps name to (placeholder, value) of the placeholders fed by FrozenGraph
+                     with value, such as the training flag with False. The batch dimension of placeholder is
+                     that of input. The placeholders not required by outputs are ignored.
+    :return: The path of frozen graph.
+    """
+    if defaults is None:
+        defaults = dict()
+    if not os.path.exists(export_dir):
+        os.makedirs(export_dir)
+
+    output_nodes = [tensor.op.name for tensor in outputs.values()]
+    graph_def = tf.graph_util.convert_variables_to_constants(sess=sess,
+                                                             input_graph_def=sess.graph.as_graph_def(),
+                                                             output_node_names=output_nodes,
+                                                             )
+    graph_def = tf.graph_util.extract_sub_graph(graph_def, output_nodes)
+
+    # Every placeholder left in the graph must be an input or fed with its default
+    placeholders = set([node.name for node in graph_def.node if node.op in ['Placeholder', 'PlaceholderV2']])
+    defaults = {key: (tensor, value) for key, (tensor, value) in defaults.items() if tensor.op.name in placeholders}
+    missing = placeholders - set([tensor.op.name for tensor in inputs.values()]) - \
+              set([tensor.op.name for tensor, _ in defaults.values()])
+    if missing:
+        raise ValueError('The placeholders {:s} must be exported as inputs or defaults.'.format(str(sorted(missing))))
+
+    graph_path = os.path.join(export_dir, '{:s}.pb'.format(name))
+    with tf.gfile.GFile(graph_path, 'wb') as file:
+        file.write(graph_def.SerializeToString())
+
+    signature = {'inputs': {key: {'name': tensor.name,
+                                  'shape': tensor.get_shape().as_list(),
+                                  'dtype': tensor.dtype.name,
+                                  } for key, tensor in inputs.items()},
+                 'outputs': {key: {'name': tensor.name,
+                                   'shape': tensor.get_shape().as_list(),
+                                   'dtype': tensor.dtype.name,
+                                   } for key, tensor in outputs.items()},
+                 'defaults': {key: {'name': tensor.name,
+                                    'shape': tensor.get_shape().as_list() if tensor.get_shape().ndims is not None
+                                    else None,
+                                    'dtype': tensor.dtype.name,
+                                    'value': np.asarray(value).item(),
+                                    } for key, (tensor, value) in defaults.items()},
+                 }
+    with open(os.path.join(export_dir, '{:s}.json'.format(name)), 'w') as file:
+        json.dump(signature, file, indent=2)
+    print('Export frozen graph to {:s}'.format(graph_path))
+    return graph_path
+
+
+class FrozenGraph:
+    """
+    A frozen graph exported by export_frozen_graph, runnable without building the network.
+    """
+
+    def __init__(self, export_dir: str, name: str = 'encoder', config: tf.ConfigProto = None):
+        """
+        :param export_dir: The directory of exported files.
+        :param name: The name of exported files.
+        :param config: The config of session.
+        """
+        with open(os.path.join(export_dir, '{:s}.json'.format(name)), 'r') as file:
+            self.signature = json.load(file)
+
+        graph_def = tf.GraphDef()
+        with tf.gfile.GFile(os.path.join(export_dir, '{:s}.pb'.format(name)), 'rb') as file:
+            graph_def.ParseFromString(file.read())
+
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            tf.import_graph_def(graph_def, name='')
+        self.inputs = {key: self.graph.get_tensor_by_name(spec['name'])
+                       for key, spec in self.signature['inputs'].items()}
+        self.outputs = {key: self.graph.get_tensor_by_name(spec['name'])
+                        for key, spec in self.signature['outputs'].items()}
+        self.defaults = self.signature.get('defaults', {})
+        self.sess = tf.Session(graph=self.graph, config=config)
+
+    def run(self, data, batch_size: int = 32, input_name: str = None, output_names: list = None) -> dict:
+        """
+        Run the graph on data batch by batch.
+        :param data: The data fed to the input, anything supports slicing along the first axis.
+        :param batch_size: The size of each batch.
+        :param input_name: The name of input, the only input by default.
+        :param output_names: The names of fetched outputs, all outputs by default.
+        :return: Dictionary maps the name of output to its results.
+        """
+        if input_name is None:
+            input_name = list(self.inputs.keys())[0]
+        if output_names is None:
+            output_names = list(self.outputs.keys())
+        fetches = {key: self.outputs[key] for key in output_names}
+
+        results = {key: list() for key in output_names}
+        for start in range(0, np.size(data, 0), batch_size):
+            data_batch = data[start: start + batch_size]
+            feed_dict = self.get_default_feeds(batch_size=np.size(data_batch, 0))
+            feed_dict[self.inputs[input_name]] = data_batch
+            results_batch = self.sess.run(fetches=fetches, feed_dict=feed_dict)
+            for key, value in results_batch.items():
+                results[key].append(value)
+        return {key: np.concatenate(value, axis=0) for key, value in results.items()}
+
+    def get_default_feeds(self, batch_size: int) -> dict:
+        """
+        Feed the placeholders exported with defaults, whose unknown dimensions are the batch size.
+        """
+        feed_dict = dict()
+        for spec in self.defaults.values():
+            shape = [batch_size if dim is None else dim for dim in spec['shape']] if spec['shape'] else []
+            feed_dict[self.graph.get_tensor_by_name(spec['name'])] = np.full(shape=shape,
+                                                                            fill_value=spec['value'],
+                                                                            dtype=spec['dtype'])
+        return feed_dict
+
+    def close(self):
+        self.sess.close()
@@ -0,0 +1,120 @@
+import collections
+import threading
+import weakref
+
+import h5py
+import numpy as np
+
+from Structure.dataset import HDF5Dataset
+
+
+def onehot_to_vector(labels, class_num: int = None) -> np.ndarray:
+    """
+    Convert one-hot labels to class indexes. The samples without any class are labeled 0.
+    :param labels: The one-hot labels with shape [samples, classes], returned directly if already a vector.
+    :param class_num: Only the first class_num classes are considered, all classes by default.
+    :return: The class indexes with shape [samples].
+    """
+    labels = np.asarray(labels)
+    if labels.ndim == 1:
+        return labels
+    if class_num is not None:
+        labels = labels[:, :class_num]
+    return np.argmax(labels, axis=1)
+
+
+def flatten_samples(data) -> np.ndarray:
+    """
+    Reshape the data to [samples, features], a view of data is returned whenever possible so that
+    neither data is copied nor its dtype changed.
+    """
+    data = np.asarray(data)
+    if data.ndim == 2:
+        return data
+    return data.reshape(np.shape(data)[0], -1)
+
+
+class LabelCache:
+    """
+    Memoize the conversions of labels, keyed by the identity of labels rather than their contents, so
+    that running classifiers repeatedly on the same fold converts each label set once without reading
+    it again. An array is identified by its object, buffer, shape and dtype, and a hdf5 dataset by its
+    file, name, address in file and shape. Only the converted results are kept, which are vectors much
+    smaller than the labels.
+    """
+
+    def __init__(self, max_size: int = 64):
+        """
+        :param max_size: The maximum number of memoized conversions, the least recently used are dropped.
+        """
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.results = collections.OrderedDict()
+
+    @staticmethod
+    def get_key(data) -> tuple:
+        """
+        The identity of data, None if data cannot be identified.
+        """
+        if isinstance(data, h5py.Dataset):
+            return 'hdf5', data.file.filename, data.name, h5py.h5o.get_info(data.id).addr, data.shape
+        if isinstance(data, np.ndarray):
+            return 'array', id(data), data.__array_interface__['data'][0], data.shape, data.dtype.str
+        return None
+
+    def convert(self, function, data, **kwargs):
+        """
+        Return function(data, **kwargs), memoized by the identity of data.
+        """
+        if isinstance(data, HDF5Dataset):
+            data = data.dataset
+        key = self.get_key(data)
+        if key is None:
+            return function(data, **kwargs)
+        key = (function.__name__, key, tuple(sorted(kwargs.items())))
+
+        with self.lock:
+            if key in self.results:
+                ref, result = self.results[key]
+                # The id of a released array may be reused by another array
+                if ref is None or ref() is data:
+                    self.results.move_to_end(key)
+                    return result
+                del self.results[key]
+
+        result = function(data, **kwargs)
+        ref = None
+        if isinstance(data, np.ndarray):
+            ref = weakref.ref(data)
+            # A view would keep data alive
+            if isinstance(result, np.ndarray) and np.shares_memory(result, data):
+                result = result.copy()
+        with self.lock:
+            self.results[key] = (ref, result)
+            while len(self.results) > self.max_size:
+                self.results.popitem(last=False)
+        return result
+
+    def clear(self):
+        with self.lock:
+            self.results.clear()
+
+
+label_cache = LabelCache()
+
+
+def format_labels(labels, class_num: int = None) -> np.ndarray:
+    """
+    The memoized onehot_to_vector.
+    """
+    return label_cache.convert(onehot_to_vector, labels, class_num=class_num)
+
+
+def format_samples(data) -> np.ndarray:
+    """
+    The samples of data with shape [samples, features]. The reshape is a view of data and not memoized,
+    so that the samples are not kept after use.
+    """
+    if isinstance(data, HDF5Dataset):
+        data = data.dataset
+    return flatten_samples(data)
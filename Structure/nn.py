@@ -1,3 +1,4 @@
+import contextlib
 import os
 import sys
 
@@ -9,9 +10,15 @@ import h5py
 import numpy as np
 import tensorflow as tf
 
-from Structure.Layer.LayerConstruct import build_layer
+from Log.profiler import profiler
+from Structure.cache import ActivationCache, load_dataset
+from Structure.controller import TrainingController, subsample
+from Structure.dataset import HDF5Dataset, HDF5Writer, iterate_batches
+from Structure.export import export_frozen_graph
+from Structure.Layer.LayerConstruct import build_layer, set_compute_dtype
+from Structure.precision import cast, get_loss_scale_optimizer, precision_policy, set_precision_policy
+from Structure.scheduler import jit, jit_scope, set_jit
 from Analyse.visualize import show_reconstruction
-from data.utils_prepare_data import create_dataset_hdf5
 
 
 class StackedConvolutionAutoEncoder(NeuralNetwork):
@@ -22,47 +29,115 @@ class StackedConvolutionAutoEncoder(NeuralNetwork):
     results = dict()
 
     def __init__(self, log=None, graph=None, scheme: int = 1):
+        # The autoencoders and results belong to the graph of each instance, not shared by the class
+        self.autoencoders = list()
+        self.tensors = dict()
+        self.parameters = list()
+        self.results = dict()
         self.set_graph(log=log, graph=graph)
         structure_xml_path = 'Structure/parameters/Scheme {:d}.xml'.format(scheme)
         self.stru_pa = parse_structure_parameters(structure_xml_path)['autoencoders']
         train_pa = parse_training_parameters('Structure/parameters/Training.xml')['autoencoders']
         self.train_pa['pre_train'] = train_pa['pre_train']
         self.train_pa['fine_tune'] = train_pa['fine_tune']
+        self.activation_cache = ActivationCache()
+        # Dictionary maps the key of structure to the built structure and optimizer, see build_structure
+        self.structures = dict()
+        # Dictionary maps the names of variables to their initializer, see initialize_variables
+        self.initializers = dict()
+        # The variables of each autoencoder, reset when the autoencoder is trained from scratch
+        self.autoencoder_variables = list()
+        # The L2 losses added by the layers of each autoencoder when it is constructed
+        self.autoencoder_L2_losses = list()
+
+        # The JIT compilation and precision policy are configured by training parameters, before the layers are built
+        if self.train_pa['pre_train'].get('jit'):
+            set_jit(enabled=True)
+        if 'precision' in self.train_pa['pre_train']:
+            set_precision_policy(name=self.train_pa['pre_train']['precision'],
+                                 loss_scale=self.train_pa['pre_train'].get('loss_scale'))
+
+        # The GLasso layers of autoencoders compute in the dtype of precision policy
+        set_compute_dtype(parameters=self.stru_pa['autoencoder'], compute_dtype=precision_policy['compute_dtype'])
 
         with self.log.graph.as_default():
             init_op_all = tf.all_variables()
             for ae_pa in self.stru_pa['autoencoder']:
+                variables = set(tf.global_variables())
+                L2_loss_start = len(tf.get_collection('L2_loss'))
                 self.autoencoders.append(AutoEncoder(parameters=ae_pa, log=self.log))
+                self.autoencoder_variables.append(set(tf.global_variables()) - variables)
+                self.autoencoder_L2_losses.append(tf.get_collection('L2_loss')[L2_loss_start:])
             for placeholder in self.stru_pa['input']:
                 self.inputs[placeholder['scope']] = build_layer(arguments=placeholder)()
 
-            self.log.saver = tf.train.Saver(tf.global_variables(), max_to_keep=1000, name='saver')
+            self.log.set_saver(var_list=tf.global_variables(), max_to_keep=1000)
             self.init_op = tf.variables_initializer(set(tf.all_variables()) -
                                                     set(init_op_all))
             self.initialization(self.init_op, name='SCAE weights')
 
-    def build_structure(self, train_index: list = None, optimizer: bool = True):
+    def build_structure(self,
+                        train_index: list = None,
+                        optimizer: bool = True,
+                        fused: bool = True,
+                        decoder: bool = True,
+                        ):
+        """
+        Build the autoencoders to be trained on top of the frozen encoder prefix.
+        :param train_index: The indexes of autoencoders to be trained, the autoencoders before
+                            train_index[0] are frozen and only used to encode the input.
+        :param optimizer: Build the optimizer of the trainable autoencoders.
+        :param fused: Wire the frozen prefix straight into the trainable autoencoders so that a
+                      batch needs only one session run, otherwise the output of the prefix is
+                      fetched and fed back through 'backpro_place' (two-stage, for debugging).
+        :param decoder: Build the decoders, only the encoders are built for inference if False.
+        :return:
+        """
         if train_index is None:
             train_index = range(len(self.autoencoders))
 
+        # Each structure is built once per graph, a built structure is reused with a fresh optimizer
+        key = (tuple(train_index), optimizer and decoder, fused, decoder, jit['enabled'])
+        if key in self.structures:
+            built = self.structures[key]
+            self.structure = built['structure']
+            if built['optimizer'] is not None:
+                # Reset the state of optimizer, including the slots, loss scale and gradient accumulators
+                self.optimizer = built['optimizer']
+                self.initialize_variables(self.optimizer['variables'])
+            print('Reuse Autoencoders')
+            return
+
         tensors = dict()
         parameters = list()
 
-        with self.log.graph.as_default():
+        # The autoencoders and optimizer are compiled with XLA if JIT is enabled
+        with self.log.graph.as_default(), jit_scope():
             feedforward_place = self.inputs['input']
             tensor = feedforward_place
             for feedforward_index in range(train_index[0]):
-                self.autoencoders[feedforward_index].build_encoder(input_tensor=tensor)
+                with self.track_variables(index=feedforward_index):
+                    self.autoencoders[feedforward_index].build_encoder(input_tensor=tensor)
                 tensor = self.autoencoders[feedforward_index].encoder_tensor
             feedforward_tensor = tensor
 
-            backpro_place = tf.placeholder(dtype=tf.float32,
-                                           shape=feedforward_tensor.get_shape().as_list(),
-                                           name='input_place')
+            if fused:
+                # The weights of the prefix are frozen, so stop gradients from flowing into it.
+                # The tensor is still feedable, which keeps 'backpro_place' usable for debugging.
+                backpro_place = tf.stop_gradient(feedforward_tensor, name='input_place')
+            else:
+                backpro_place = tf.placeholder(dtype=feedforward_tensor.dtype.base_dtype,
+                                               shape=feedforward_tensor.get_shape().as_list(),
+                                               name='input_place')
             tensor = backpro_place
+
+            # The losses added by the trainable autoencoders of this structure
+            SICE_loss_start = len(tf.get_collection('SICE_loss'))
+            L1_loss_start = len(tf.get_collection('L1_loss'))
             for backward_index in train_index:
                 autoencoder = self.autoencoders[backward_index]
-                autoencoder.build_encoder(input_tensor=tensor)
+                with self.track_variables(index=backward_index):
+                    autoencoder.build_encoder(input_tensor=tensor)
                 ae_tensors = autoencoder.encoder.tensors
                 tensors[autoencoder.encoder.scope] = ae_tensors
                 if 'weight' in ae_tensors:
@@ -74,9 +149,10 @@ class StackedConvolutionAutoEncoder(NeuralNetwork):
 
             encoder_tensor = tensor
 
-            for backward_index in reversed(train_index):
+            for backward_index in (reversed(train_index) if decoder else []):
                 autoencoder = self.autoencoders[backward_index]
-                autoencoder.build_decoder(input_tensor=tensor)
+                with self.track_variables(index=backward_index):
+                    autoencoder.build_decoder(input_tensor=tensor)
                 ae_tensors = autoencoder.decoder.tensors
                 tensors[autoencoder.decoder.scope] = ae_tensors
                 tensor = self.autoencoders[backward_index].decoder_tensor
@@ -85,23 +161,178 @@ class StackedConvolutionAutoEncoder(NeuralNetwork):
                 # if 'bias' in ae_tensors:
                 #     parameters.append(ae_tensors['bias'])
 
-            output_tensor = tensor
+            output_tensor = tensor if decoder else None
+            square_errors = None
+            if decoder:
+                # The square errors are computed in float32 whatever the precision policy, which are the
+                # only source of the MSE reported by training, validation and the exported graph
+                axis = list(range(1, len(output_tensor.get_shape().as_list())))
+                square_errors = tf.reduce_mean(tf.square(cast(output_tensor, tf.float32) -
+                                                         cast(backpro_place, tf.float32)), axis=axis)
+
             self.structure = {'feedforward_place': feedforward_place,
                               'feedforward_tensor': feedforward_tensor,
                               'backpro_place': backpro_place,
                               'input_place': backpro_place,
                               'encoder_tensor': encoder_tensor,
                               'output_tensor': output_tensor,
+                              'square_errors': square_errors,
                               'tensors': tensors,
-                              'parameters': parameters
+                              'parameters': parameters,
+                              'fused': fused,
+                              'SICE_losses': tf.get_collection('SICE_loss')[SICE_loss_start:],
+                              'L1_losses': tf.get_collection('L1_loss')[L1_loss_start:],
+                              'L2_losses': [L2_loss for index in train_index
+                                            for L2_loss in self.autoencoder_L2_losses[index]],
                               }
             print('Build Autoencoders')
 
-            if optimizer:
+            built = {'structure': self.structure, 'optimizer': None}
+            if optimizer and decoder:
+                variables = set(tf.global_variables())
                 self.build_optimizer(output_tensor=self.structure['output_tensor'],
                                      output_place=self.structure['backpro_place'],
                                      lr_place=self.inputs['learning_rate'],
                                      )
+                # The minimizer of build_optimizer is kept unless loss scaling or gradient accumulation
+                # needs an optimizer shared with the accumulator
+                if self.requires_shared_optimizer():
+                    self.build_minimizer()
+                # The variables of optimizer, extended by build_accumulator
+                self.optimizer['variables'] = list(set(tf.global_variables()) - variables)
+                built['optimizer'] = self.optimizer
+            self.structures[key] = built
+
+    @contextlib.contextmanager
+    def track_variables(self, index: int):
+        """
+        Add the variables created within the scope, such as those of batch normalization, to the variables
+        of the autoencoder with index.
+        """
+        variables = set(tf.global_variables())
+        yield
+        self.autoencoder_variables[index].update(set(tf.global_variables()) - variables)
+
+    def reset_variables(self, train_index: list = None):
+        """
+        Re-initialize the variables of the autoencoders to be trained, so that they are trained from scratch
+        with the structures already built. The other autoencoders keep their weights.
+        :param train_index: The indexes of autoencoders to be reset, all autoencoders by default.
+        """
+        if train_index is None:
+            train_index = range(len(self.autoencoders))
+        variables = set()
+        for index in train_index:
+            variables.update(self.autoencoder_variables[index])
+        self.initialize_variables(list(variables))
+
+    def initialize_variables(self, variables: list):
+        """
+        Run the initializer of variables, which is built once for each set of variables.
+        """
+        key = tuple(sorted([variable.name for variable in variables]))
+        if key not in self.initializers:
+            with self.log.graph.as_default():
+                self.initializers[key] = tf.variables_initializer(variables)
+        self.sess.run(self.initializers[key])
+
+    def requires_shared_optimizer(self) -> bool:
+        """
+        Whether the minimizer of build_optimizer is replaced by build_minimizer, which is needed by the loss
+        scaling of precision policy and by the gradient accumulation of any training process.
+        """
+        if precision_policy['loss_scale'] is not None:
+            return True
+        return any([self.train_pa[process].get('accumulation_steps', 1) > 1
+                    for process in ['pre_train', 'fine_tune']])
+
+    def build_minimizer(self):
+        """
+        Build the minimizer with the optimizer shared by the gradient accumulator, see get_optimizer, so that
+        the slots of optimizer are kept when accumulation_steps changes between stages.
+        """
+        optimizer = self.get_optimizer()
+        variables = set(tf.global_variables())
+        grads_and_vars = self.compute_gradients(optimizer=optimizer)
+        self.optimizer['minimizer'] = optimizer.apply_gradients(grads_and_vars,
+                                                                global_step=self.optimizer['global_step'])
+        self.initialization(tf.variables_initializer(set(tf.global_variables()) - variables),
+                            name='shared optimizer')
+
+    def get_loss(self):
+        """
+        The loss of current structure, which is the mean square error and the SICE, L1 and L2 losses of the
+        trainable autoencoders unless the optimizer provides its loss.
+        """
+        loss = self.optimizer.get('loss')
+        if loss is None:
+            loss = tf.reduce_mean(self.structure['square_errors'])
+            regularizers = self.structure['SICE_losses'] + self.structure['L1_losses'] + self.structure['L2_losses']
+            if regularizers:
+                loss += tf.add_n([cast(regularizer, tf.float32) for regularizer in regularizers])
+        return loss
+
+    def get_optimizer(self) -> tf.train.Optimizer:
+        """
+        The optimizer of current structure shared by the minimizer and the gradient accumulator, which is the
+        optimizer provided by build_optimizer or Adam, wrapped with the loss scaling of precision policy.
+        """
+        if 'shared_optimizer' not in self.optimizer:
+            optimizer = self.optimizer.get('optimizer')
+            if optimizer is None:
+                optimizer = tf.train.AdamOptimizer(learning_rate=self.optimizer['lr_place'])
+            self.optimizer['shared_optimizer'] = get_loss_scale_optimizer(optimizer=optimizer)
+        return self.optimizer['shared_optimizer']
+
+    def compute_gradients(self, optimizer: tf.train.Optimizer) -> list:
+        # The frozen autoencoders have no gradients
+        return [(grad, var) for grad, var in optimizer.compute_gradients(self.get_loss()) if grad is not None]
+
+    def build_accumulator(self) -> dict:
+        """
+        Build the ops accumulating the gradients of micro-batches, which are applied as the gradient of
+        the whole batch. The gradient of each micro-batch is weighted by its size, and the sum is divided
+        by the total size, which equals the gradient of the mean loss over the whole batch.
+        :return: Dictionary of the placeholder of micro-batch size, the op accumulating the gradient of a
+                 micro-batch, and the op applying the accumulated gradient and then resetting it.
+        """
+        if 'accumulator' in self.optimizer:
+            return self.optimizer['accumulator']
+
+        # The accumulated training step is compiled with XLA as the minimizer if JIT is enabled
+        with self.log.graph.as_default(), jit_scope():
+            variables = set(tf.global_variables())
+            optimizer = self.get_optimizer()
+            grads_and_vars = self.compute_gradients(optimizer=optimizer)
+
+            size_place = tf.placeholder(dtype=tf.float32, shape=[], name='micro_batch_size')
+            count = tf.Variable(0., trainable=False, name='accumulated_size')
+            accumulators = [tf.Variable(tf.zeros(shape=var.shape, dtype=var.dtype.base_dtype),
+                                        trainable=False,
+                                        name='{:s}/accumulator'.format(var.op.name))
+                            for _, var in grads_and_vars]
+
+            # The sparse gradients of gathered variables are densified to be accumulated
+            accumulate = tf.group(*([tf.assign_add(accumulator, tf.convert_to_tensor(grad) * size_place)
+                                     for accumulator, (grad, _) in zip(accumulators, grads_and_vars)] +
+                                    [tf.assign_add(count, size_place)]))
+            apply = optimizer.apply_gradients([(accumulator / tf.cast(count, accumulator.dtype), var)
+                                               for accumulator, (_, var) in zip(accumulators, grads_and_vars)],
+                                              global_step=self.optimizer['global_step'])
+            with tf.control_dependencies([apply]):
+                reset = tf.group(*([tf.assign(accumulator, tf.zeros_like(accumulator))
+                                    for accumulator in accumulators] +
+                                   [tf.assign(count, 0.)]))
+
+            accumulator_variables = list(set(tf.global_variables()) - variables)
+            self.optimizer['variables'].extend(accumulator_variables)
+            self.initialization(tf.variables_initializer(accumulator_variables), name='gradient accumulator')
+
+        self.optimizer['accumulator'] = {'size_place': size_place,
+                                         'accumulate': accumulate,
+                                         'apply': reset,
+                                         }
+        return self.optimizer['accumulator']
 
     def build_classifier(self, subfolder_name: str = None, scheme: int = 4, tag: str = 'pre_train'):
         self.build_structure(optimizer=False)
@@ -117,50 +348,74 @@ class StackedConvolutionAutoEncoder(NeuralNetwork):
                                        )
         return classifier
 
+    def get_feed_dict(self, data_batch: np.ndarray, learning_rate: float = None, encoded: bool = False) -> dict:
+        """
+        Build the feed dict of a batch for the current structure.
+        :param data_batch: The batch of raw input data.
+        :param learning_rate: The learning rate fed to the optimizer.
+        :param encoded: The batch has already been encoded by the frozen prefix.
+        :return: The feed dict with the input of the trainable autoencoders.
+        """
+        if encoded:
+            feed_dict = {self.structure['backpro_place']: data_batch}
+        elif self.structure['fused']:
+            feed_dict = {self.structure['feedforward_place']: data_batch}
+        else:
+            # Two-stage: encode the batch with the frozen prefix and feed it back
+            data_batch = self.sess.run(fetches=self.structure['feedforward_tensor'],
+                                       feed_dict={
+                                           self.structure['feedforward_place']: data_batch
+                                       })
+            feed_dict = {self.structure['backpro_place']: data_batch}
+
+        if learning_rate is not None:
+            feed_dict[self.optimizer['lr_place']] = learning_rate
+        return feed_dict
+
+    def encode_prefix(self, data_batch: np.ndarray) -> np.ndarray:
+        """
+        Encode a batch of data with the frozen autoencoders of current structure.
+        """
+        return self.sess.run(fetches=self.structure['feedforward_tensor'],
+                             feed_dict={self.structure['feedforward_place']: data_batch})
+
     def feedforward(self,
                     data: np.ndarray,
                     epoch: int = 0,
                     tag: str = 'Train',
                     if_print: bool = True,
                     if_save: bool = True,
+                    fetches: list = None,
                     ):
-        data_size = np.size(data, 0)
-        batch_size = self.train_pa['pre_train']['train_batch_size']
-        learning_rate = self.train_pa['pre_train']['learning_rate']
-
+        """
+        Encode and reconstruct the data.
+        :param data: The data to be encoded and reconstructed.
+        :param epoch: The epoch of log.
+        :param tag: The type of log, such as 'Train', 'Valid' or 'Test'.
+        :param if_print: Print the progress and the mean square error.
+        :param if_save: Save the mean square error to log.
+        :param fetches: The intermediate tensors to be fetched, see resolve_fetches. The results are
+                        stored in self.results['tensors'].
+        :return: The data, encoder, reconstruction and square errors of each sample, the reconstruction
+                 and square errors are None if the decoders are not built.
+        """
+        decoder = self.structure['output_tensor'] is not None
         encoders = list()
         reconstructions = list()
         mses = list()
+        tensors = dict()
 
-        steps = (data_size - 1) // batch_size + 1
-        for step in range(steps):
-            data_batch = data[step * batch_size: (step + 1) * batch_size]
-
-            # Feedforward
-            data_batch = self.sess.run(fetches=self.structure['feedforward_tensor'],
-                                       feed_dict={
-                                           self.structure['feedforward_place']: data_batch
-                                       })
-
-            results_batch, tensors_batch, recon_batch, mses_batch, encoder_batch, = \
-                self.sess.run(fetches=[self.optimizer['results'],
-                                       self.structure['tensors'],
-                                       self.structure['output_tensor'],
-                                       self.optimizer['square_errors'],
-                                       self.structure['encoder_tensor'],
-                                       ],
-                              feed_dict={
-                                  self.structure['backpro_place']: data_batch,
-                                  self.optimizer['lr_place']: learning_rate,
-                              })
+        for encoder_batch, recon_batch, mses_batch, tensors_batch in \
+                self.feedforward_batches(data=data, if_print=if_print, fetches=fetches):
             encoders.append(encoder_batch)
-            reconstructions.append(recon_batch)
-            mses.extend(mses_batch)
-
-            if if_print:
-                msg = '\rProcessing {:3d} of {:3d}  MSE: {:5e}'.format(step + 1, steps, np.mean(mses_batch))
-                sys.stdout.write(msg)
-        if if_print:
+            if decoder:
+                reconstructions.append(recon_batch)
+                mses.extend(mses_batch)
+            for name, value in tensors_batch.items():
+                tensors.setdefault(name, list()).append(value)
+        self.results['tensors'] = {name: np.concatenate(value, 0) for name, value in tensors.items()}
+
+        if if_print and decoder:
             results = {'MSE': np.mean(mses)}
             self.log.write_log(res=results,
                                epoch=epoch,
@@ -172,46 +427,152 @@ class StackedConvolutionAutoEncoder(NeuralNetwork):
             print()
 
         encoder = np.concatenate(encoders, 0)
+        if not decoder:
+            return data, encoder, None, None
         reconstruction = np.concatenate(reconstructions, 0)
         return data, encoder, reconstruction, mses
 
-    def backpropagation_epoch(self, data, epoch, pas):
+    def resolve_fetches(self, fetches: list = None) -> dict:
+        """
+        Look up the intermediate tensors of current structure.
+        :param fetches: List of layer scopes such as 'encoder1', which fetch all per-sample tensors of the
+                        layer, or tensor names such as 'encoder1/output'.
+        :return: Dictionary maps 'scope/name' to tensor.
+        """
+        tensors = dict()
+        for fetch in fetches if fetches else []:
+            if fetch in self.structure['tensors']:
+                for name, tensor in self.structure['tensors'][fetch].items():
+                    if self.is_sample_tensor(tensor):
+                        tensors['{:s}/{:s}'.format(fetch, name)] = tensor
+                continue
+
+            scope, _, name = fetch.rpartition('/')
+            try:
+                tensor = self.structure['tensors'][scope][name]
+            except KeyError:
+                raise KeyError('Tensor {:s} not found in current structure.'.format(fetch))
+            if not self.is_sample_tensor(tensor):
+                raise ValueError('Tensor {:s} has no batch dimension and can not be fetched '
+                                 'per sample.'.format(fetch))
+            tensors[fetch] = tensor
+        return tensors
+
+    def is_sample_tensor(self, tensor) -> bool:
+        """
+        Check whether the tensor holds one entry per sample, i.e. its leading dimension is the batch
+        dimension of the feedforward placeholder. Variables and parameters such as weights do not.
+        :param tensor: The tensor to be checked.
+        :return: True if the tensor is batched along the first axis.
+        """
+        if isinstance(tensor, tf.Variable) or not isinstance(tensor, tf.Tensor):
+            return False
+        shape = tensor.shape
+        if shape.ndims is None or shape.ndims < 1:
+            return False
+
+        batch_size = self.structure['feedforward_place'].shape[0].value
+        leading = shape[0].value
+        return leading is None or leading == batch_size
+
+    def feedforward_batches(self, data: np.ndarray, if_print: bool = True, fetches: list = None):
+        """
+        Feedforward the data batch by batch.
+        :param data: The data to be encoded and reconstructed.
+        :param if_print: Print the progress.
+        :param fetches: The intermediate tensors to be fetched, see resolve_fetches. No intermediate
+                        tensor is fetched by default.
+        :return: Generator of the encoder, reconstruction, square errors and dictionary of fetched
+                 tensors of each batch, the reconstruction and square errors are None if the
+                 decoders are not built.
+        """
+        data_size = np.size(data, 0)
+        batch_size = self.train_pa['pre_train']['train_batch_size']
+
+        # Only the requested tensors are fetched, the optimizer is not run
+        fetches = {'encoder': self.structure['encoder_tensor'],
+                   'tensors': self.resolve_fetches(fetches=fetches),
+                   }
+        if self.structure['output_tensor'] is not None:
+            fetches['output'] = self.structure['output_tensor']
+            fetches['square_errors'] = self.structure['square_errors']
+
+        steps = (data_size - 1) // batch_size + 1
+        for step in range(steps):
+            data_batch = data[step * batch_size: (step + 1) * batch_size]
+
+            results_batch = self.sess.run(fetches=fetches,
+                                          feed_dict=self.get_feed_dict(data_batch=data_batch))
+            mses_batch = results_batch.get('square_errors')
+
+            if if_print:
+                msg = '\rProcessing {:3d} of {:3d}'.format(step + 1, steps)
+                if mses_batch is not None:
+                    msg += '  MSE: {:5e}'.format(np.mean(mses_batch))
+                sys.stdout.write(msg)
+
+            yield results_batch['encoder'], results_batch.get('output'), mses_batch, results_batch['tensors']
+
+    def backpropagation_epoch(self, data, epoch, pas, encoded: bool = False):
         mses = list()
 
-        # Shuffle
+        # Start training with shuffled batches
         train_data_size = np.size(data, axis=0)
-        random_index = np.random.permutation(train_data_size)
-        train_data = data[random_index]
-
-        # Start training
         batch_size = pas['train_batch_size']
         learning_rate = pas['learning_rate'] * pas['decay_rate'] ** np.floor(epoch / pas['decay_step'])
+
+        # Split each batch into micro-batches whose gradients are accumulated before applied
+        accumulation_steps = pas.get('accumulation_steps', 1)
+        if accumulation_steps > 1:
+            accumulator = self.build_accumulator()
+            batch_size = (batch_size - 1) // accumulation_steps + 1
+            global_step = self.sess.run(self.optimizer['global_step'])
         train_steps = (train_data_size - 1) // batch_size + 1
-        for train_step in range(train_steps):
-            train_data_batch = train_data[train_step * batch_size: (train_step + 1) * batch_size]
 
-            # Feedforward
-            train_data_batch = self.sess.run(fetches=self.structure['feedforward_tensor'],
-                                             feed_dict={
-                                                 self.structure['feedforward_place']: train_data_batch
-                                             })
+        # Prepare the next batches in background while the current step runs
+        place = self.structure['backpro_place'] if encoded else self.structure['feedforward_place']
+        sample_shape = place.get_shape().as_list()[1:] if place.get_shape().ndims else None
+        batches = iterate_batches(data=data,
+                                  batch_size=batch_size,
+                                  shuffle=True,
+                                  depth=pas.get('prefetch_depth', 2),
+                                  dtype=np.float32,
+                                  shape=sample_shape if sample_shape and None not in sample_shape else None,
+                                  )
+        for train_step, train_data_batch in enumerate(profiler.iterate(batches, name='data wait')):
 
             # Backpropagation
-            results_batch, _, mses_batch, global_step, = \
-                self.sess.run(fetches=[self.optimizer['results'],
-                                       self.optimizer['minimizer'],
-                                       self.optimizer['square_errors'],
-                                       self.optimizer['global_step'],
-                                       ],
-                              feed_dict={
-                                  self.structure['backpro_place']: train_data_batch,
-                                  self.optimizer['lr_place']: learning_rate,
-                              })
+            with profiler.phase('optimizer step'):
+                feed_dict = self.get_feed_dict(data_batch=train_data_batch,
+                                               learning_rate=learning_rate,
+                                               encoded=encoded)
+                if accumulation_steps > 1:
+                    feed_dict[accumulator['size_place']] = len(train_data_batch)
+                    results_batch, _, mses_batch, = \
+                        self.sess.run(fetches=[self.optimizer['results'],
+                                               accumulator['accumulate'],
+                                               self.structure['square_errors'],
+                                               ],
+                                      feed_dict=feed_dict,
+                                      **profiler.run_kwargs())
+                    if (train_step + 1) % accumulation_steps == 0 or train_step + 1 == train_steps:
+                        _, global_step = self.sess.run(fetches=[accumulator['apply'], self.optimizer['global_step']],
+                                                       feed_dict={self.optimizer['lr_place']: learning_rate})
+                else:
+                    results_batch, _, mses_batch, global_step, = \
+                        self.sess.run(fetches=[self.optimizer['results'],
+                                               self.optimizer['minimizer'],
+                                               self.structure['square_errors'],
+                                               self.optimizer['global_step'],
+                                               ],
+                                      feed_dict=feed_dict,
+                                      **profiler.run_kwargs())
 
             mses.extend(mses_batch)
 
-            message = '{:4d}/{:d}\t'.format(train_step + 1, train_steps)
-            self.log.write_log(res=results_batch, epoch=global_step, pre_fix=message)
+            with profiler.phase('logging'):
+                message = '{:4d}/{:d}\t'.format(train_step + 1, train_steps)
+                self.log.write_log(res=results_batch, epoch=global_step, pre_fix=message, aggregate=True)
 
         results = {'MSE': np.mean(mses_batch)}
         self.log.write_log(res=results,
@@ -223,19 +584,30 @@ class StackedConvolutionAutoEncoder(NeuralNetwork):
                         train_pa: dict,
                         show_flag: bool = False,
                         start_epoch: int = 0,
+                        encoded: bool = False,
                         ) -> str:
         """
 
         :param data: Dictionary which has key: train data, valid data, test data
         :param show_flag:
         :param start_epoch:
-        :param train_pa
-        :return:
+        :param train_pa: The training parameters. The optional keys 'patience', 'min_delta',
+                         'adaptive_test_cycle', 'max_test_cycle' and 'valid_samples' configure
+                         early stopping and validation, see TrainingController.
+        :param encoded: The train data has already been encoded by the frozen prefix.
+        :return: The prefix of the checkpoint with the best validation MSE, which is restored once training
+                 finishes, or the last checkpoint without validation data.
         """
         self.write_graph()
         save_path = None
+        best_path = None
 
         training_parameters = train_pa
+        controller = TrainingController.from_parameters(train_pa=training_parameters, start_epoch=start_epoch)
+        if 'valid data' in data:
+            valid_data = subsample(data=data['valid data'], samples=training_parameters.get('valid_samples'))
+
+        epoch = start_epoch - 1
         for epoch in np.arange(start=start_epoch, stop=training_parameters['training_cycle']):
             if show_flag:
                 show_reconstruction(data=data['valid data'],
@@ -250,24 +622,46 @@ class StackedConvolutionAutoEncoder(NeuralNetwork):
             self.backpropagation_epoch(data=data['train data'],
                                        epoch=epoch,
                                        pas=training_parameters,
+                                       encoded=encoded,
                                        )
 
-            if (epoch + 1) % training_parameters['test_cycle'] == 0:
-                # Valid
-                if 'valid data' in data:
-                    self.feedforward(data=data['valid data'],
-                                     epoch=epoch,
-                                     tag='Valid')
-
-                # Test
-                if 'test data' in data:
-                    self.feedforward(data=data['test data'],
-                                     epoch=epoch,
-                                     tag='Test')
-
-            # Save
-            if (epoch + 1) % training_parameters['save_cycle'] == 0:
-                save_path = self.log.save_model(epoch=epoch + 1)
+            # Valid
+            valid_mse = None
+            if 'valid data' in data and controller.should_validate(epoch=epoch):
+                with profiler.phase('validation'):
+                    _, _, _, mses = self.feedforward(data=valid_data,
+                                                     epoch=epoch,
+                                                     tag='Valid')
+                valid_mse = np.mean(mses)
+                improved = controller.update(epoch=epoch, valid_mse=valid_mse)
+            else:
+                improved = False
+
+            # Save on every improvement so that the best model is kept for model selection
+            if (epoch + 1) % training_parameters['save_cycle'] == 0 or controller.stop or improved:
+                save_path = self.log.save_model(epoch=epoch + 1, metric=valid_mse)
+                if improved:
+                    best_path = save_path
+
+            profiler.end_epoch(epoch=epoch + 1, log=self.log)
+
+            if controller.stop:
+                print('Early stopping at epoch {:d}, the best valid MSE {:5e} at epoch {:d}.'.format(
+                    epoch + 1, controller.best_mse, controller.best_epoch))
+                break
+
+        # Continue from the best model rather than the one up to patience epochs past it
+        if best_path is not None:
+            if best_path != save_path:
+                self.log.restore(restored_path=best_path, initialize=False)
+            save_path = best_path
+
+        # Test only once training has finished
+        if 'test data' in data:
+            with profiler.phase('test'):
+                self.feedforward(data=data['test data'],
+                                 epoch=epoch,
+                                 tag='Test')
 
         return save_path
 
@@ -284,25 +678,41 @@ class StackedConvolutionAutoEncoder(NeuralNetwork):
         if train_indexes is None:
             train_indexes = [[0, 1], [2, 3]]
 
-        data = {'train data': np.array(fold['pre train data'])}
+        data = load_dataset(fold['pre train data'])
+        # The activations of the frozen autoencoders belong to the previous fold
+        self.activation_cache.reset()
 
         for train_index in train_indexes:
             if start_index is not None and train_index != start_index:
                 continue
 
             self.build_structure(train_index=train_index)
+            # Train the autoencoders of the stage from scratch unless restored, the frozen autoencoders
+            # keep the weights of previous stages
+            self.reset_variables(train_index=train_index)
+
+            # set stage and subfolder name such as 'fold 1/pre_train_SCAE/0-1', then resume the stage
+            self.log.set_stage(fold=fold.name.split('/')[-1], process='pre_train_SCAE', indexes=train_index)
             start_epoch = self.log.restore()
 
-            # set subfolder name such as 'fold 1/pre_train_SCAE/0-1'
-            subfolder_name = '{:s}/pre_train_SCAE/{:s}'.format(
-                fold.name.split('/')[-1], '-'.join([str(i) for i in train_index])
-            )
-            self.log.set_filepath_by_subfolder(subfolder_name=subfolder_name)
+            # Encode the data with the frozen autoencoders once and reuse it across epochs
+            encoded = train_index[0] > 0
+            if encoded:
+                with profiler.phase('feedforward prefix'):
+                    train_data = self.activation_cache.get(prefix=train_index[0],
+                                                           data=data,
+                                                           encode=self.encode_prefix,
+                                                           batch_size=self.train_pa['pre_train']['train_batch_size'])
+            else:
+                train_data = data
+
             show_flag = True if 0 in train_index else False
-            save_path = self.backpropagation(data=data,
+            save_path = self.backpropagation(data={'train data': train_data},
                                              start_epoch=start_epoch,
                                              show_flag=False,
-                                             train_pa=self.train_pa['pre_train'])
+                                             train_pa=self.train_pa['pre_train'],
+                                             encoded=encoded)
+            self.activation_cache.invalidate(start=train_index[0])
 
             restore_path = None
             start_index = None
@@ -313,19 +723,16 @@ class StackedConvolutionAutoEncoder(NeuralNetwork):
         if not isinstance(fold, h5py.Group):
             raise TypeError('The fold must be type of h5py.Group.')
 
-        data = {'train data': np.array(fold['train data']),
-                'valid data': np.array(fold['valid data']),
-                'test data': np.array(fold['test data']),
+        data = {'train data': load_dataset(fold['train data']),
+                'valid data': load_dataset(fold['valid data']),
+                'test data': load_dataset(fold['test data']),
                 }
 
         self.build_structure()
-        start_epoch = self.log.restore()
 
-        # set subfolder name
-        fold_name = fold.name.split('/')[-1]
-        index_str = 'fine_tune_SCAE'
-        subfolder_name = '{:s}/{:s}'.format(fold_name, index_str)
-        self.log.set_filepath_by_subfolder(subfolder_name=subfolder_name)
+        # set stage and subfolder name such as 'fold 1/fine_tune_SCAE', then resume the stage
+        self.log.set_stage(fold=fold.name.split('/')[-1], process='fine_tune_SCAE')
+        start_epoch = self.log.restore()
 
         save_path = self.backpropagation(data=data,
                                          start_epoch=start_epoch,
@@ -338,35 +745,101 @@ class StackedConvolutionAutoEncoder(NeuralNetwork):
                 save_path = os.path.join(save_dir, '{:s}/fine_tune_SCAE/model/train.model_300'.format(fold_idx))
             self.encode_fold(fold=folds['fold {:d}'.format(fold_idx)], save_path=save_path)
 
-    def encode_fold(self, fold: h5py.Group, save_path: str = None, num_split: int = None):
-        self.build_structure()
-        self.log.restore()
+    def encode_fold(self,
+                    fold: h5py.Group,
+                    save_path: str = None,
+                    num_split: int = None,
+                    compression: str = None,
+                    fetches: list = None,
+                    ):
+        """
+        Encode and reconstruct the data of fold, and write the results batch by batch to the fold.
+        :param fold: The fold with datasets 'train data', 'valid data' and 'test data'.
+        :param save_path: The checkpoint to be restored, the best checkpoint of fine tuning by default.
+        :param num_split: Group every num_split consecutive encoders into a sample.
+        :param compression: The compression filter of written datasets, such as 'lzf' or 'gzip'.
+        :param fetches: The intermediate tensors to be written as '{tag} data {scope} {name}', see
+                        resolve_fetches.
+        :return:
+        """
+        self.build_structure(optimizer=False)
+        self.log.set_stage(fold=fold.name.split('/')[-1], process='fine_tune_SCAE')
+        self.log.restore(restored_path=save_path, best=True)
 
         for tag in ['train', 'valid', 'test']:
             data_tag = '{:s} data'.format(tag)
 
             try:
-                data_tmp = np.array(fold[data_tag])
+                data_tmp = HDF5Dataset(fold[data_tag])
             except KeyError as e:
                 print(e)
                 continue
 
-            _, encoder, reconstruction, mses = self.feedforward(data=data_tmp, if_save=False)
-
-            # reshape
-            batch_size = np.shape(encoder)[0]
-            new_shape = [batch_size // num_split, num_split, -1] if num_split else [batch_size, -1]
-            encoder = np.reshape(encoder, newshape=new_shape)
-
-            # save to hdf5 file
-            create_dataset_hdf5(group=fold,
-                                name='{:s} output'.format(data_tag),
-                                data=reconstruction,
-                                )
-            create_dataset_hdf5(group=fold,
-                                name='{:s} encoder'.format(data_tag),
-                                data=encoder,
-                                )
+            # save to hdf5 file as each batch is produced
+            output_writer = HDF5Writer(group=fold,
+                                       name='{:s} output'.format(data_tag),
+                                       compression=compression)
+            encoder_writer = HDF5Writer(group=fold,
+                                        name='{:s} encoder'.format(data_tag),
+                                        rows_per_item=num_split,
+                                        compression=compression)
+            tensor_writers = dict()
+            mses = list()
+            for encoder_batch, recon_batch, mses_batch, tensors_batch in \
+                    self.feedforward_batches(data=data_tmp, fetches=fetches):
+                output_writer.append(recon_batch)
+                encoder_writer.append(np.reshape(encoder_batch, [np.shape(encoder_batch)[0], -1]))
+                mses.extend(mses_batch)
+                for name, value in tensors_batch.items():
+                    if name not in tensor_writers:
+                        tensor_writers[name] = HDF5Writer(group=fold,
+                                                          name='{:s} {:s}'.format(data_tag, name.replace('/', ' ')),
+                                                          compression=compression)
+                    tensor_writers[name].append(value)
+            for writer in [output_writer, encoder_writer] + list(tensor_writers.values()):
+                writer.close()
+            print('\r\n{:s}  MSE: {:5e}'.format(data_tag, np.mean(mses)))
+
+    def export_encoder(self,
+                       export_dir: str,
+                       fold: str = None,
+                       save_path: str = None,
+                       decoder: bool = False,
+                       name: str = 'encoder',
+                       ) -> str:
+        """
+        Export the fine tuned encoder as a frozen graph, which is loaded by Structure.export.FrozenGraph
+        without the scheme files.
+        :param export_dir: The directory of exported files.
+        :param fold: The name of fold whose best fine tuned checkpoint is restored.
+        :param save_path: The checkpoint to be restored, overrides fold.
+        :param decoder: Export the reconstruction and square errors as well.
+        :param name: The name of exported files.
+        :return: The path of frozen graph.
+        """
+        self.build_structure(optimizer=False, decoder=decoder)
+        if fold is not None:
+            self.log.set_stage(fold=fold, process='fine_tune_SCAE')
+        self.log.restore(restored_path=save_path, best=True)
+
+        outputs = {'encoder': self.structure['encoder_tensor']}
+        if decoder:
+            outputs['output'] = self.structure['output_tensor']
+            outputs['square_errors'] = self.structure['square_errors']
+
+        # The other placeholders, such as the training flag and the labels masking the GLasso regularizer,
+        # are fed as in inference with False or zeros
+        defaults = {scope: (placeholder, False if placeholder.dtype == tf.bool else 0)
+                    for scope, placeholder in self.inputs.items()
+                    if placeholder is not self.structure['feedforward_place'] and
+                    isinstance(placeholder, tf.Tensor) and placeholder.op.type == 'Placeholder'}
+        return export_frozen_graph(sess=self.sess,
+                                   inputs={'input': self.structure['feedforward_place']},
+                                   outputs=outputs,
+                                   export_dir=export_dir,
+                                   name=name,
+                                   defaults=defaults,
+                                   )
 
     def train_folds(self, folds: h5py.Group,
                     pre_train: bool = True,
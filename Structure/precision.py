@@ -0,0 +1,70 @@
+import tensorflow as tf
+
+# The precision policies, the variables are always kept in float32 as master weights
+policies = {'float32': {'compute_dtype': tf.float32, 'loss_scale': None},
+            'mixed_bfloat16': {'compute_dtype': tf.bfloat16, 'loss_scale': None},
+            'mixed_float16': {'compute_dtype': tf.float16, 'loss_scale': 'dynamic'},
+            }
+
+# The precision policy of current process, set by set_precision_policy before building graphs
+precision_policy = {'name': 'float32',
+                    'compute_dtype': tf.float32,
+                    'variable_dtype': tf.float32,
+                    'loss_scale': None,
+                    }
+
+
+def set_precision_policy(name: str = 'float32', loss_scale=None) -> dict:
+    """
+    Set the precision policy of the graphs built afterwards.
+    :param name: The name of policy, 'float32', 'mixed_bfloat16' or 'mixed_float16'.
+    :param loss_scale: The loss scale, a float for a fixed scale, 'dynamic' for dynamic loss scaling,
+                       the default of policy if None.
+    :return: The precision policy.
+    """
+    if name not in policies:
+        raise ValueError('The precision policy must be one of {:s} but got {:s}.'.format(str(list(policies)), name))
+
+    precision_policy['name'] = name
+    precision_policy['compute_dtype'] = policies[name]['compute_dtype']
+    precision_policy['loss_scale'] = loss_scale if loss_scale is not None else policies[name]['loss_scale']
+    return precision_policy
+
+
+def get_compute_dtype(dtype: str or tf.DType = None) -> tf.DType:
+    """
+    The dtype of computation, the dtype of policy if not given.
+    """
+    if dtype is None:
+        return precision_policy['compute_dtype']
+    return tf.as_dtype(dtype)
+
+
+def cast(tensor, dtype: tf.DType):
+    """
+    Cast the floating tensor to dtype, the other tensors are returned directly.
+    """
+    if tensor.dtype.base_dtype == dtype or not tensor.dtype.is_floating:
+        return tensor
+    return tf.cast(tensor, dtype=dtype)
+
+
+def get_loss_scale_optimizer(optimizer: tf.train.Optimizer, loss_scale=None) -> tf.train.Optimizer:
+    """
+    Wrap the optimizer with loss scaling, which avoids the underflow of float16 gradients.
+    :param optimizer: The optimizer to be wrapped.
+    :param loss_scale: The loss scale, the loss scale of policy if None.
+    :return: The wrapped optimizer, or optimizer if there is no loss scale.
+    """
+    if loss_scale is None:
+        loss_scale = precision_policy['loss_scale']
+    if loss_scale is None:
+        return optimizer
+
+    mixed_precision = tf.contrib.mixed_precision
+    if loss_scale == 'dynamic':
+        manager = mixed_precision.ExponentialUpdateLossScaleManager(init_loss_scale=2 ** 15,
+                                                                    incr_every_n_steps=2000)
+    else:
+        manager = mixed_precision.FixedLossScaleManager(loss_scale=float(loss_scale))
+    return mixed_precision.LossScaleOptimizer(optimizer, manager)
@@ -0,0 +1,221 @@
+import contextlib
+import os
+import multiprocessing
+
+import numpy as np
+import tensorflow as tf
+
+# The thread budget of current process, set in the workers of FoldScheduler
+thread_budget = {'intra_op_threads': 0,
+                 'inter_op_threads': 0,
+                 }
+
+
+def set_thread_budget(intra_op_threads: int = 0, inter_op_threads: int = 0):
+    """
+    Limit the CPU threads used by tensorflow sessions of current process. The threads of the numeric
+    libraries are read from the environment when they are imported, see thread_environment.
+    :param intra_op_threads: The number of threads used within an op, 0 lets tensorflow decide.
+    :param inter_op_threads: The number of ops run in parallel, 0 lets tensorflow decide.
+    :return:
+    """
+    thread_budget['intra_op_threads'] = intra_op_threads
+    thread_budget['inter_op_threads'] = inter_op_threads
+
+
+@contextlib.contextmanager
+def thread_environment(intra_op_threads: int = 0):
+    """
+    Set the threads of the numeric libraries in the environment within the scope, which is inherited by the
+    processes spawned in it before they import numpy and tensorflow.
+    :param intra_op_threads: The number of threads, 0 leaves the environment unchanged.
+    """
+    envs = ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS'] if intra_op_threads else []
+    saved = {env: os.environ.get(env) for env in envs}
+    for env in envs:
+        os.environ[env] = str(intra_op_threads)
+    try:
+        yield
+    finally:
+        for env, value in saved.items():
+            if value is None:
+                os.environ.pop(env, None)
+            else:
+                os.environ[env] = value
+
+
+# The XLA JIT compilation of current process, set by set_jit before building graphs
+jit = {'enabled': False}
+
+
+def set_jit(enabled: bool = True):
+    """
+    Compile the graphs built afterwards with XLA. The ops built within jit_scope are compiled, and the
+    sessions configured by set_jit_level compile the other ops as well where tensorflow supports it. No
+    process-wide flag is set, so that JIT can be disabled again within the process.
+    :param enabled: Enable XLA JIT compilation.
+    :return:
+    """
+    jit['enabled'] = enabled
+
+
+def jit_scope():
+    """
+    The scope whose ops are compiled with XLA if JIT is enabled, otherwise a scope doing nothing.
+    """
+    if not jit['enabled']:
+        return contextlib.nullcontext()
+    return tf.contrib.compiler.jit.experimental_jit_scope(compile_ops=True)
+
+
+def session_config() -> tf.ConfigProto:
+    """
+    The session config respecting the thread budget and JIT compilation of current process.
+    """
+    config = tf.ConfigProto(intra_op_parallelism_threads=thread_budget['intra_op_threads'],
+                            inter_op_parallelism_threads=thread_budget['inter_op_threads'],
+                            )
+    return set_jit_level(config)
+
+
+def set_jit_level(config: tf.ConfigProto) -> tf.ConfigProto:
+    """
+    A copy of the session config whose global JIT level follows the JIT compilation of current process.
+    """
+    jit_config = tf.ConfigProto()
+    jit_config.CopyFrom(config)
+    jit_config.graph_options.optimizer_options.global_jit_level = \
+        tf.OptimizerOptions.ON_1 if jit['enabled'] else tf.OptimizerOptions.OFF
+    return jit_config
+
+
+class FoldScheduler:
+    """
+    Run independent jobs such as (run_time, fold) of cross validation in a pool of processes.
+    Each job runs in a fresh process, so that it builds its own graph and session.
+    """
+
+    def __init__(self,
+                 workers: int = 1,
+                 intra_op_threads: int = None,
+                 inter_op_threads: int = 1,
+                 maxtasksperchild: int = 1,
+                 ):
+        """
+        :param workers: The number of worker processes, jobs run in current process if not greater than 1.
+        :param intra_op_threads: The threads of each worker, the CPUs are shared equally by default.
+        :param inter_op_threads: The number of ops run in parallel in each worker.
+        :param maxtasksperchild: The number of jobs run by a worker before it is replaced, None reuses
+                                 the workers for all jobs, which suits the jobs without tensorflow graphs.
+        """
+        self.workers = max(1, workers)
+        if intra_op_threads is None:
+            intra_op_threads = max(1, (os.cpu_count() or 1) // self.workers)
+        self.intra_op_threads = intra_op_threads
+        self.inter_op_threads = inter_op_threads
+        self.maxtasksperchild = maxtasksperchild
+
+    def run(self, function, jobs: list, job_kwargs: dict = None, **kwargs) -> dict:
+        """
+        Run function(job, **kwargs) for each job.
+        :param function: The function run in workers, which must be picklable (defined at module level).
+        :param jobs: The list of hashable jobs, such as (run_time, fold).
+        :param job_kwargs: Dictionary maps job to the keyword arguments passed only to this job, such as
+                           the data of its fold, so that the other jobs do not pickle them.
+        :param kwargs: The keyword arguments passed to function.
+        :return: Dictionary maps job to the result of function.
+        """
+        if job_kwargs is None:
+            job_kwargs = dict()
+
+        results = dict()
+        if self.workers <= 1:
+            for job in jobs:
+                results[job] = function(job, **kwargs, **job_kwargs.get(job, {}))
+            return results
+
+        # Spawn the workers rather than fork them, since tensorflow is not fork-safe. The workers replaced
+        # after maxtasksperchild jobs are spawned later, so the environment is kept for the lifetime of pool
+        context = multiprocessing.get_context('spawn')
+        with thread_environment(intra_op_threads=self.intra_op_threads):
+            pool = context.Pool(processes=min(self.workers, len(jobs)),
+                                initializer=set_thread_budget,
+                                initargs=(self.intra_op_threads, self.inter_op_threads),
+                                maxtasksperchild=self.maxtasksperchild,
+                                )
+            try:
+                async_results = [(job, pool.apply_async(function,
+                                                        args=(job,),
+                                                        kwds=dict(kwargs, **job_kwargs.get(job, {}))))
+                                 for job in jobs]
+                for job, async_result in async_results:
+                    results[job] = async_result.get()
+                    print('Job {:s} finished.'.format(str(job)))
+            except BaseException:
+                # Stop the remaining jobs instead of waiting for them before the error is raised
+                pool.terminate()
+                pool.join()
+                raise
+            pool.close()
+            pool.join()
+        return results
+
+
+def merge_results(results: dict) -> dict:
+    """
+    Merge the metrics of folds.
+    :param results: Dictionary maps job to the dictionary of metrics such as {'MSE': 0.1}.
+    :return: Dictionary with the metrics of each job, and the mean and std of each metric over jobs.
+    """
+    metrics = dict()
+    for job in sorted(results):
+        if not isinstance(results[job], dict):
+            continue
+        for metric, value in results[job].items():
+            if np.isscalar(value):
+                metrics.setdefault(metric, []).append(value)
+
+    return {'jobs': results,
+            'mean': {metric: np.mean(values) for metric, values in metrics.items()},
+            'std': {metric: np.std(values) for metric, values in metrics.items()},
+            }
+
+
+def train_framework_fold(job: tuple,
+                         scheme: str,
+                         restored_date: str = None,
+                         restore_time: str = None,
+                         cache_dir: str = None,
+                         jit_enabled: bool = False,
+                         **kwargs):
+    """
+    Train one fold of one run with a Framework in current process.
+    :param job: Tuple of (run_time, fold).
+    :param scheme: The scheme of Framework.
+    :param restored_date: The date folder of the log shared by all jobs.
+    :param restore_time: The time folder of the log, each job logs into the folder suffixed with its run and fold.
+    :param cache_dir: The directory of the fold cache shared by all jobs, None reads the hdf5 file directly.
+    :param jit_enabled: Compile the graphs with XLA.
+    :param kwargs: The keyword arguments passed to Framework.train_folds.
+    :return: The result of Framework.train_folds.
+    """
+    from Log.log import Log
+    from Structure.cache import set_fold_cache
+    from Structure.Framework import Framework
+
+    set_fold_cache(cache_dir=cache_dir)
+    set_jit(enabled=jit_enabled)
+
+    run_time, fold = job
+    if restore_time:
+        # Each job logs into its own folder, such as '10-30 run 8 fold 1'
+        restore_time = '{:s} run {:d} fold {:d}'.format(restore_time, run_time, fold)
+    log = Log(restored_date=restored_date,
+              restore_time=restore_time,
+              config=session_config(),
+              )
+    frame = Framework(scheme=scheme, log=log)
+    return frame.train_folds(start_fold=fold,
+                             end_fold=fold,
+                             run_time=run_time,
+                             **kwargs)
@@ -0,0 +1,411 @@
+import argparse
+import functools
+import json
+import multiprocessing
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from Structure import scheduler
+from Structure.Layer.CNNWithGLasso import EdgeToEdgeWithGLasso, EdgeToNodeWithGLasso, SICEParameterization, \
+    build_SICE_regularizer, initial_tril_vector
+
+
+def loop_tril_vector(size: int, in_channels: int, out_channels: int, stddev: float, loc: float = 1):
+    """
+    The original loop of EdgeToNodeWithGLasso.get_initial_weight, kept as reference.
+    """
+    tril_vec = np.zeros(shape=[in_channels, out_channels, int(size * (size + 1) / 2), ])
+    for in_channel in range(in_channels):
+        for out_channel in range(out_channels):
+            for i in range(int(size / 2) + 1):
+                tril_vec[in_channel, out_channel, i * size + i - 1] = np.random.normal(scale=stddev)
+                tril_vec[in_channel, out_channel, i * size] = np.random.normal(loc=loc, scale=stddev)
+                tril_vec[in_channel, out_channel, i * size - 1] = np.random.normal(loc=loc, scale=stddev)
+                tril_vec[in_channel, out_channel, i * size - 1 - size + i] = np.random.normal(scale=stddev)
+    return tril_vec
+
+
+def benchmark_initializer(sizes: list = None,
+                          in_channels: int = 1,
+                          out_channels: int = 64,
+                          repeat: int = 3,
+                          ) -> list:
+    """
+    Compare the time of initializing the lower triangular factors by the loop and the vectorized initializer.
+    :return: List of results with the best time in seconds of each initializer.
+    """
+    if sizes is None:
+        sizes = [90, 116, 200]
+
+    results = list()
+    for size in sizes:
+        times = dict()
+        for name, initializer in [('loop', loop_tril_vector), ('vectorized', initial_tril_vector)]:
+            elapsed = list()
+            for _ in range(repeat):
+                start = time.perf_counter()
+                initializer(size=size, in_channels=in_channels, out_channels=out_channels, stddev=0.1)
+                elapsed.append(time.perf_counter() - start)
+            times[name] = min(elapsed)
+
+        result = {'size': size,
+                  'in_channels': in_channels,
+                  'out_channels': out_channels,
+                  'loop': times['loop'],
+                  'vectorized': times['vectorized'],
+                  'speedup': times['loop'] / times['vectorized'],
+                  }
+        results.append(result)
+        print('Size: {:3d}    Loop: {:.4f}s    Vectorized: {:.4f}s    Speedup: {:.1f}x'.format(
+            size, result['loop'], result['vectorized'], result['speedup']))
+    return results
+
+
+def peak_rss() -> float:
+    """
+    The peak resident set size of current process in MB, which never decreases within a process, so that
+    it is the RSS of a case only if the case runs in its own process, see run_isolated.
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_isolated(function, isolate: bool = True, **kwargs):
+    """
+    Run function(**kwargs) in a fresh spawned process, so that the peak RSS, the graphs and the process-wide
+    settings such as XLA of a case do not leak into the others.
+    :param function: The function defined at module level.
+    :param isolate: Run in a fresh process, otherwise in current process.
+    :return: The result of function.
+    """
+    if not isolate:
+        return function(**kwargs)
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(processes=1, maxtasksperchild=1) as pool:
+        return pool.apply(function, kwds=kwargs)
+
+
+def time_steps(sess: tf.Session, fetches, feed_dict: dict, steps: int, warmup: int) -> float:
+    """
+    The median seconds of running fetches, after warmup steps.
+    """
+    for _ in range(warmup):
+        sess.run(fetches, feed_dict=feed_dict)
+    elapsed = list()
+    for _ in range(steps):
+        start = time.perf_counter()
+        sess.run(fetches, feed_dict=feed_dict)
+        elapsed.append(time.perf_counter() - start)
+    return float(np.median(elapsed))
+
+
+def benchmark_graph(build_fun,
+                    batch_size: int,
+                    steps: int = 10,
+                    warmup: int = 2,
+                    config: tf.ConfigProto = None,
+                    jit_enabled: bool = False,
+                    ) -> dict:
+    """
+    Measure the build time, forward and backward latency of a graph.
+    :param build_fun: Function builds the graph in the default graph, and returns the dictionary of
+                      placeholder to the fed value and the output tensor.
+    :param batch_size: The batch size of fed values, used to compute throughput.
+    :param steps: The number of timed steps.
+    :param warmup: The number of steps before timing.
+    :param config: The config of session.
+    :param jit_enabled: Compile the graph with XLA.
+    :return: Dictionary of the build time, forward and backward latency in seconds, throughput in
+             samples per second and peak RSS in MB.
+    """
+    scheduler.set_jit(enabled=jit_enabled)
+    config = scheduler.set_jit_level(config) if config is not None else scheduler.session_config()
+
+    with tf.Graph().as_default():
+        start = time.perf_counter()
+        with scheduler.jit_scope():
+            feed_dict, output = build_fun()
+            loss = tf.reduce_mean(output)
+            minimizer = tf.train.GradientDescentOptimizer(learning_rate=1e-6).minimize(loss)
+        build_time = time.perf_counter() - start
+
+        with tf.Session(config=config) as sess:
+            sess.run(tf.global_variables_initializer())
+            forward = time_steps(sess, output, feed_dict=feed_dict, steps=steps, warmup=warmup)
+            backward = time_steps(sess, minimizer, feed_dict=feed_dict, steps=steps, warmup=warmup)
+
+    return {'build_time': build_time,
+            'forward_latency': forward,
+            'backward_latency': backward,
+            'throughput': batch_size / backward,
+            'peak_rss': peak_rss(),
+            }
+
+
+def build_E2E(n_features: int, batch_size: int, in_channels: int, out_channels: int):
+    layer = EdgeToEdgeWithGLasso(arguments={'kernel_shape': [n_features, n_features, in_channels, out_channels],
+                                            'n_class': 2,
+                                            'padding': 'VALID',
+                                            })
+    input_place = tf.placeholder(dtype=tf.float32, shape=[batch_size, n_features, n_features, in_channels])
+    output = layer.convolution(input_tensor=input_place, vectorize=layer.pa['vectorize'])
+    data = np.random.normal(size=[batch_size, n_features, n_features, in_channels])
+    return {input_place: data}, output
+
+
+def build_E2N(n_features: int, batch_size: int, in_channels: int, out_channels: int):
+    layer = EdgeToNodeWithGLasso(arguments={'kernel_shape': [n_features, n_features, in_channels, out_channels],
+                                            'n_class': 2,
+                                            'padding': 'VALID',
+                                            })
+    covariance_place = tf.placeholder(dtype=tf.float32, shape=[batch_size, n_features, n_features, in_channels])
+    outputs = layer.convolution(covariance_tensor=covariance_place,
+                                weights=[layer.weight, layer.weight_SICE],
+                                vectorize=layer.pa['vectorize'],
+                                share_covariance=layer.pa['share_covariance'])
+    output = tf.add_n([tf.reduce_mean(output) for output in outputs])
+    data = np.random.normal(size=[batch_size, n_features, n_features, in_channels])
+    return {covariance_place: data}, output
+
+
+def build_SICE(n_features: int, batch_size: int, in_channels: int, out_channels: int):
+    L = tf.Variable(tf.truncated_normal(shape=[in_channels, out_channels, n_features * (n_features + 1) // 2],
+                                        stddev=0.01))
+    SICE = SICEParameterization(L=L, n_features=n_features)
+    weight = tf.transpose(SICE.weight, perm=[2, 3, 0, 1])
+    output_place = tf.placeholder(dtype=tf.float32, shape=[batch_size, n_features, 1, out_channels])
+    output = build_SICE_regularizer(weight=weight, L=SICE.L_tril, output=output_place,
+                                    log_diagonal=SICE.log_diagonal)
+    output = tf.reduce_mean(output['Log determinant']) + tf.reduce_mean(output['Norm 1']) + \
+             tf.reduce_mean(output['Trace'])
+    data = np.random.normal(size=[batch_size, n_features, 1, out_channels])
+    return {output_place: data}, output
+
+
+def benchmark_layer(case: str,
+                    size: int,
+                    batch_size: int,
+                    out_channels: int,
+                    steps: int = 10,
+                    warmup: int = 2,
+                    jit_enabled: bool = False,
+                    ) -> dict:
+    """
+    Benchmark a GLasso layer of case in 'E2E', 'E2N' and 'SICE' on synthetic data, see benchmark_graph.
+    """
+    build_funs = {'E2E': build_E2E, 'E2N': build_E2N, 'SICE': build_SICE}
+    result = {'case': case,
+              'size': size,
+              'batch_size': batch_size,
+              'in_channels': 1,
+              'out_channels': out_channels,
+              'jit': jit_enabled,
+              }
+    result.update(benchmark_graph(functools.partial(build_funs[case],
+                                                    n_features=size,
+                                                    batch_size=batch_size,
+                                                    in_channels=1,
+                                                    out_channels=out_channels),
+                                  batch_size=batch_size,
+                                  steps=steps,
+                                  warmup=warmup,
+                                  jit_enabled=jit_enabled))
+    return result
+
+
+def benchmark_layers(cases: list = None,
+                     sizes: list = None,
+                     batch_sizes: list = None,
+                     channels: list = None,
+                     steps: int = 10,
+                     warmup: int = 2,
+                     jit_enabled: bool = False,
+                     isolate: bool = True,
+                     ) -> list:
+    """
+    Benchmark the GLasso layers across ROI counts, batch sizes and output channels on synthetic data.
+    :param cases: The cases in 'E2E', 'E2N' and 'SICE', all cases by default.
+    :param jit_enabled: Benchmark each case with XLA as well, and report the speedup of backward latency.
+    :param isolate: Run each case in its own process, see run_isolated.
+    :return: List of results.
+    """
+    cases = cases or ['E2E', 'E2N', 'SICE']
+    sizes = sizes or [90, 116, 200]
+    batch_sizes = batch_sizes or [8, 32]
+    channels = channels or [8, 32]
+
+    results = list()
+    for case in cases:
+        for size in sizes:
+            for batch_size in batch_sizes:
+                for out_channels in channels:
+                    baseline = None
+                    for jit in ([False, True] if jit_enabled else [False]):
+                        result = run_isolated(benchmark_layer,
+                                              isolate=isolate,
+                                              case=case,
+                                              size=size,
+                                              batch_size=batch_size,
+                                              out_channels=out_channels,
+                                              steps=steps,
+                                              warmup=warmup,
+                                              jit_enabled=jit)
+                        if baseline is None:
+                            baseline = result
+                        else:
+                            result['speedup'] = baseline['backward_latency'] / result['backward_latency']
+                        results.append(result)
+                        print('{:4s}{:4s}  Size: {:3d}  Batch: {:3d}  Channels: {:3d}    Build: {:.3f}s    '
+                              'Forward: {:.4f}s    Backward: {:.4f}s    {:.1f} samples/s    RSS: {:.0f}MB'.format(
+                               case, ' XLA' if jit else '', size, batch_size, out_channels, result['build_time'],
+                               result['forward_latency'], result['backward_latency'], result['throughput'],
+                               result['peak_rss']) +
+                              ('    Speedup: {:.2f}x'.format(result['speedup']) if 'speedup' in result else ''))
+    scheduler.set_jit(enabled=False)
+    return results
+
+
+def benchmark_SCAE_case(scheme: int, batch_size: int, samples: int = 256, epochs: int = 2) -> dict:
+    """
+    Benchmark StackedConvolutionAutoEncoder.backpropagation_epoch with batch_size, see benchmark_SCAE.
+    The logs are written to a temporary directory.
+    """
+    from Log.log import Log
+    from Structure.nn import StackedConvolutionAutoEncoder
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        start = time.perf_counter()
+        log = Log(config=scheduler.session_config())
+        log.basic_path = temp_dir
+        log.set_file_path()
+        scae = StackedConvolutionAutoEncoder(log=log, scheme=scheme)
+        scae.build_structure()
+        scae.write_graph()
+        build_time = time.perf_counter() - start
+
+        shape = scae.structure['feedforward_place'].get_shape().as_list()[1:]
+        data = np.random.normal(size=[samples] + shape).astype(np.float32)
+        pas = dict(scae.train_pa['pre_train'], train_batch_size=batch_size)
+
+        elapsed = list()
+        for epoch in range(epochs):
+            start = time.perf_counter()
+            scae.backpropagation_epoch(data=data, epoch=epoch, pas=pas)
+            elapsed.append(time.perf_counter() - start)
+        log.close()
+
+    epoch_time = float(np.median(elapsed[1:] if epochs > 1 else elapsed))
+    steps = (samples - 1) // batch_size + 1
+    return {'case': 'SCAE',
+            'scheme': scheme,
+            'batch_size': batch_size,
+            'samples': samples,
+            'build_time': build_time,
+            'epoch_time': epoch_time,
+            'backward_latency': epoch_time / steps,
+            'throughput': samples / epoch_time,
+            'peak_rss': peak_rss(),
+            }
+
+
+def benchmark_SCAE(scheme: int = 1,
+                   batch_sizes: list = None,
+                   samples: int = 256,
+                   epochs: int = 2,
+                   isolate: bool = True,
+                   ) -> list:
+    """
+    Benchmark StackedConvolutionAutoEncoder.backpropagation_epoch on synthetic data of the input shape of scheme.
+    The first epoch is taken as warmup.
+    :param isolate: Run each batch size in its own process, see run_isolated.
+    :return: List of results.
+    """
+    batch_sizes = batch_sizes or [8, 32]
+    results = list()
+    for batch_size in batch_sizes:
+        result = run_isolated(benchmark_SCAE_case,
+                              isolate=isolate,
+                              scheme=scheme,
+                              batch_size=batch_size,
+                              samples=samples,
+                              epochs=epochs)
+        results.append(result)
+        print('SCAE  Batch: {:3d}    Build: {:.3f}s    Epoch: {:.3f}s    Step: {:.4f}s    '
+              '{:.1f} samples/s    RSS: {:.0f}MB'.format(batch_size, result['build_time'], result['epoch_time'],
+                                                       result['backward_latency'], result['throughput'],
+                                                       result['peak_rss']))
+    return results
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_arguments(argv: list = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Benchmark the GLasso layers and the SCAE training step.')
+    parser.add_argument('--cases', nargs='+', default=['initializer', 'E2E', 'E2N', 'SICE', 'SCAE'],
+                        choices=['initializer', 'E2E', 'E2N', 'SICE', 'SCAE'])
+    parser.add_argument('--sizes', nargs='+', type=int, default=[90, 116, 200], help='The ROI counts.')
+    parser.add_argument('--batch-sizes', nargs='+', type=int, default=[8, 32])
+    parser.add_argument('--channels', nargs='+', type=int, default=[8, 32], help='The output channels.')
+    parser.add_argument('--steps', type=int, default=10, help='The number of timed steps.')
+    parser.add_argument('--warmup', type=int, default=2, help='The number of steps before timing.')
+    parser.add_argument('--scheme', type=int, default=1, help='The scheme of SCAE.')
+    parser.add_argument('--samples', type=int, default=256, help='The number of synthetic samples of SCAE.')
+    parser.add_argument('--jit', action='store_true',
+                        help='Benchmark the layers with XLA as well and report the speedup.')
+    parser.add_argument('--in-process', action='store_true',
+                        help='Run all cases in this process, the peak RSS is then cumulative over cases.')
+    parser.add_argument('--output', default='benchmark.json', help='The JSON file of results.')
+    return parser.parse_args(argv)
+
+
+def main(argv: list = None) -> dict:
+    arguments = parse_arguments(argv)
+
+    results = list()
+    if 'initializer' in arguments.cases:
+        for result in benchmark_initializer(sizes=arguments.sizes):
+            result['case'] = 'initializer'
+            results.append(result)
+
+    layer_cases = [case for case in arguments.cases if case in ['E2E', 'E2N', 'SICE']]
+    if layer_cases:
+        results.extend(benchmark_layers(cases=layer_cases,
+                                        sizes=arguments.sizes,
+                                        batch_sizes=arguments.batch_sizes,
+                                        channels=arguments.channels,
+                                        steps=arguments.steps,
+                                        warmup=arguments.warmup,
+                                        jit_enabled=arguments.jit,
+                                        isolate=not arguments.in_process))
+
+    if 'SCAE' in arguments.cases:
+        results.extend(benchmark_SCAE(scheme=arguments.scheme,
+                                      batch_sizes=arguments.batch_sizes,
+                                      samples=arguments.samples,
+                                      isolate=not arguments.in_process))
+
+    report = {'commit': git_commit(),
+              'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+              'python': sys.version.split()[0],
+              'tensorflow': tf.__version__,
+              'arguments': vars(arguments),
+              'results': results,
+              }
+    with open(arguments.output, 'w') as file:
+        json.dump(report, file, indent=2)
+    print('Results are written to {:s}'.format(arguments.output))
+    return report
+
+
+if __name__ == '__main__':
+    main()
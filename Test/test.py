@@ -1,5 +1,464 @@
+import os
+import tempfile
+import unittest
+
+import h5py
 import numpy as np
+import tensorflow as tf
+
+from Log.manifest import RunManifest
+from Structure.Layer.CNNWithGLasso import EdgeToEdgeWithGLasso, EdgeToNodeWithGLasso, SICEParameterization, \
+    build_SICE_regularizer, initial_tril_vector
+from Structure.cache import FoldCache
+from Structure.controller import TrainingController
+from Structure.dataset import HDF5Dataset
+from Structure.export import FrozenGraph, export_frozen_graph
+from Structure.precision import precision_policy, set_precision_policy
+from Structure.Layer.LayerConstruct import build_layer
+from Structure.label import LabelCache, flatten_samples, onehot_to_vector
+from Structure.nn import StackedConvolutionAutoEncoder
+from Test.benchmark import loop_tril_vector
+
+
+class TestEdgeToEdgeWithGLasso(unittest.TestCase):
+
+    def test_vectorized_convolution(self):
+        """
+        The single convolution must be equivalent to the convolutions of each row of weight.
+        """
+        for n_features, padding in [(16, 'SAME'), (16, 'VALID'), (90, 'VALID')]:
+            with tf.Graph().as_default():
+                layer = EdgeToEdgeWithGLasso(arguments={'kernel_shape': [n_features, n_features, 2, 3],
+                                                        'n_class': 2,
+                                                        'padding': padding,
+                                                        })
+                input_tensor = tf.constant(np.random.normal(size=[4, n_features, n_features, 2]),
+                                           dtype=tf.float32)
+                outputs = [layer.convolution(input_tensor=input_tensor, vectorize=vectorize)
+                           for vectorize in [False, True]]
+
+                with tf.Session() as sess:
+                    sess.run(tf.global_variables_initializer())
+                    output_loop, output_vectorized = sess.run(outputs)
+
+            self.assertEqual(np.shape(output_loop), np.shape(output_vectorized))
+            np.testing.assert_allclose(output_vectorized, output_loop, rtol=1e-4, atol=1e-4)
+
+
+class TestEdgeToNodeWithGLasso(unittest.TestCase):
+
+    def test_vectorized_convolution(self):
+        """
+        The batched contractions must be equivalent to the convolutions of each row of covariance.
+        """
+        for n_features, padding in [(16, 'SAME'), (16, 'VALID'), (90, 'VALID')]:
+            with tf.Graph().as_default():
+                layer = EdgeToNodeWithGLasso(arguments={'kernel_shape': [n_features, n_features, 1, 4],
+                                                        'n_class': 2,
+                                                        'padding': padding,
+                                                        })
+                covariance_tensor = tf.constant(np.random.normal(size=[4, n_features, n_features, 1]),
+                                                dtype=tf.float32)
+                weights = [layer.weight, layer.weight_SICE]
+                outputs = [layer.convolution(covariance_tensor=covariance_tensor,
+                                             weights=weights,
+                                             vectorize=vectorize,
+                                             share_covariance=share_covariance)
+                           for vectorize, share_covariance in [(False, False), (True, True), (True, False)]]
+
+                with tf.Session() as sess:
+                    sess.run(tf.global_variables_initializer())
+                    outputs_loop, outputs_shared, outputs_separate = sess.run(outputs)
+
+            for output_loop, output_shared, output_separate in zip(outputs_loop, outputs_shared, outputs_separate):
+                self.assertEqual(np.shape(output_loop), np.shape(output_shared))
+                np.testing.assert_allclose(output_shared, output_loop, rtol=1e-4, atol=1e-4)
+                np.testing.assert_allclose(output_separate, output_loop, rtol=1e-4, atol=1e-4)
+
+    def test_initial_tril_vector(self):
+        """
+        The vectorized initializer must fill the same elements as the loop and be reproducible.
+        """
+        for size in [2, 3, 90, 91]:
+            tril_loop = loop_tril_vector(size=size, in_channels=2, out_channels=3, stddev=1e-6, loc=1)
+            tril_vectorized = initial_tril_vector(size=size, in_channels=2, out_channels=3, stddev=1e-6, loc=1,
+                                                  rng=np.random.default_rng(0))
+            np.testing.assert_array_equal(tril_vectorized != 0, tril_loop != 0)
+            np.testing.assert_array_equal(np.round(tril_vectorized), np.round(tril_loop))
+
+        tril_vectors = [initial_tril_vector(size=90, in_channels=1, out_channels=4, stddev=0.1,
+                                            rng=np.random.default_rng(1)) for _ in range(2)]
+        np.testing.assert_array_equal(tril_vectors[0], tril_vectors[1])
+
+
+class TestSICEParameterization(unittest.TestCase):
+
+    def test_fill_triangular(self):
+        """
+        The precomputed indexes must be equivalent to fill_triangular with identity added.
+        """
+        n_features = 16
+        with tf.Graph().as_default():
+            L = tf.constant(np.random.normal(size=[2, 3, n_features * (n_features + 1) // 2]), dtype=tf.float32)
+            SICE = SICEParameterization(L=L, n_features=n_features)
+            L_tril = tf.contrib.distributions.fill_triangular(L) + \
+                     tf.eye(num_rows=n_features, batch_shape=[2, 3])
+            weight = tf.matmul(L_tril, tf.transpose(L_tril, perm=[0, 1, 3, 2]))
+            log_diagonal = tf.log(tf.square(tf.matrix_diag_part(L_tril)))
+
+            with tf.Session() as sess:
+                results = sess.run([SICE.L_tril, L_tril, SICE.weight, weight, SICE.log_diagonal, log_diagonal])
+
+        for result_parameterized, result in zip(results[::2], results[1::2]):
+            np.testing.assert_allclose(result_parameterized, result, rtol=1e-5, atol=1e-5)
+
+
+class TestPrecisionPolicy(unittest.TestCase):
+
+    def tearDown(self):
+        set_precision_policy(name='float32')
+
+    def test_compute_dtype(self):
+        """
+        The layers must compute in the dtype of policy, with float32 variables and regularizer.
+        """
+        set_precision_policy(name='mixed_float16')
+        self.assertEqual(precision_policy['loss_scale'], 'dynamic')
+        n_features = 16
+        with tf.Graph().as_default():
+            layer = EdgeToNodeWithGLasso(arguments={'kernel_shape': [n_features, n_features, 1, 4],
+                                                    'n_class': 2,
+                                                    'padding': 'VALID',
+                                                    })
+            covariance_tensor = tf.constant(np.random.normal(size=[4, n_features, n_features, 1]),
+                                            dtype=tf.float32)
+            output, output_SICE = layer.convolution(covariance_tensor=covariance_tensor,
+                                                    weights=[layer.weight, layer.weight_SICE])
+            regularizer = build_SICE_regularizer(weight=layer.weight_SICE,
+                                                 L=layer.tensors['L'],
+                                                 output=output_SICE,
+                                                 log_diagonal=layer.SICE.log_diagonal)
+
+        self.assertEqual(output.dtype, tf.float16)
+        self.assertEqual(layer.weight.dtype.base_dtype, tf.float32)
+        for tensor in regularizer.values():
+            self.assertEqual(tensor.dtype, tf.float32)
+
+    def test_activation_dtype(self):
+        """
+        The activations between layers must stay in the compute dtype, with the losses in float32.
+        """
+        set_precision_policy(name='mixed_float16')
+        n_features = 16
+        with tf.Graph().as_default():
+            layer = EdgeToEdgeWithGLasso(arguments={'kernel_shape': [n_features, n_features, 1, 2],
+                                                    'n_class': 2,
+                                                    'padding': 'VALID',
+                                                    })
+            output = layer.build(input_tensor=tf.zeros(shape=[4, n_features, n_features, 1]),
+                                 output_tensor=tf.zeros(shape=[4, 2]),
+                                 training=tf.constant(False))
+
+            self.assertEqual(output.dtype, tf.float16)
+            for loss in tf.get_collection('L1_loss'):
+                self.assertEqual(loss.dtype, tf.float32)
+
+    def test_plain_layer_inputs(self):
+        """
+        The layers outside precision policy must accept the activations of the GLasso layers.
+        """
+        set_precision_policy(name='mixed_float16')
+        n_features = 16
+        with tf.Graph().as_default():
+            layer = build_layer(arguments={'type': 'EdgeToEdgeWithGLasso',
+                                           'kernel_shape': [n_features, n_features, 1, 2],
+                                           'n_class': 2,
+                                           'padding': 'VALID',
+                                           'compute_dtype': precision_policy['compute_dtype'],
+                                           })
+            output = layer.build(input_tensor=tf.zeros(shape=[4, n_features, n_features, 1]),
+                                 output_tensor=tf.zeros(shape=[4, 2]),
+                                 training=tf.constant(False))
+            self.assertEqual(output.dtype, tf.float16)
+
+            dense = build_layer(arguments={'type': 'FullyConnected',
+                                           'kernel_shape': [n_features * n_features * 2, 2],
+                                           'scope': 'dense',
+                                           })
+            output = dense.build(input_tensor=tf.reshape(output, shape=[4, -1]))
+            self.assertEqual(output.dtype, tf.float32)
+
+
+class TestFetches(unittest.TestCase):
+
+    def test_sample_tensors(self):
+        """
+        A layer scope must only fetch the per-sample tensors, and a parameter must not be fetched by name.
+        """
+        with tf.Graph().as_default():
+            input_place = tf.placeholder(dtype=tf.float32, shape=[None, 4, 4, 1])
+            weight = tf.Variable(np.ones(shape=[4, 4, 1, 2], dtype=np.float32))
+            scae = StackedConvolutionAutoEncoder.__new__(StackedConvolutionAutoEncoder)
+            scae.structure = {'feedforward_place': input_place,
+                              'tensors': {'encoder1': {'output': tf.nn.conv2d(input_place, weight,
+                                                                              strides=[1, 1, 1, 1],
+                                                                              padding='VALID'),
+                                                       'weight': weight,
+                                                       'bias': tf.zeros(shape=[2]),
+                                                       'L': tf.zeros(shape=[4, 4]),
+                                                       },
+                                          },
+                              }
+
+            self.assertEqual(list(scae.resolve_fetches(['encoder1'])), ['encoder1/output'])
+            self.assertEqual(list(scae.resolve_fetches(['encoder1/output'])), ['encoder1/output'])
+            for fetch in ['encoder1/weight', 'encoder1/bias', 'encoder1/L']:
+                with self.assertRaises(ValueError):
+                    scae.resolve_fetches([fetch])
+            with self.assertRaises(KeyError):
+                scae.resolve_fetches(['encoder1/input'])
+
+
+class TestMinimizer(unittest.TestCase):
+
+    def tearDown(self):
+        set_precision_policy(name='float32')
+
+    def test_default_minimizer(self):
+        """
+        The minimizer of build_optimizer must be kept by default, and only replaced for loss scaling or
+        gradient accumulation.
+        """
+        scae = StackedConvolutionAutoEncoder.__new__(StackedConvolutionAutoEncoder)
+        scae.train_pa = {'pre_train': {}, 'fine_tune': {'accumulation_steps': 1}}
+        with tf.Graph().as_default():
+            minimizer = tf.no_op()
+            scae.optimizer = {'minimizer': minimizer}
+            scae.build_minimizer = lambda: scae.optimizer.update(minimizer=None)
+            if scae.requires_shared_optimizer():
+                scae.build_minimizer()
+        self.assertIs(scae.optimizer['minimizer'], minimizer)
+
+        scae.train_pa['fine_tune']['accumulation_steps'] = 4
+        self.assertTrue(scae.requires_shared_optimizer())
+        scae.train_pa['fine_tune']['accumulation_steps'] = 1
+        set_precision_policy(name='mixed_float16')
+        self.assertTrue(scae.requires_shared_optimizer())
+
+    def test_loss(self):
+        """
+        The loss of the shared minimizer must include the SICE, L1 and L2 losses of the structure.
+        """
+        scae = StackedConvolutionAutoEncoder.__new__(StackedConvolutionAutoEncoder)
+        with tf.Graph().as_default():
+            scae.optimizer = dict()
+            scae.structure = {'square_errors': tf.constant([1., 3.]),
+                              'SICE_losses': [tf.constant(1.)],
+                              'L1_losses': [tf.constant(2., dtype=tf.float16)],
+                              'L2_losses': [tf.constant(3.), tf.constant(4.)],
+                              }
+            with tf.Session() as sess:
+                self.assertAlmostEqual(sess.run(scae.get_loss()), 12.)
+
+
+class TestFrozenGraph(unittest.TestCase):
+
+    def test_round_trip(self):
+        """
+        The frozen graph must feed the training flag and labels by default and reproduce the inference outputs.
+        """
+        data = np.random.normal(size=[10, 4]).astype(np.float32)
+        with tempfile.TemporaryDirectory() as temp_dir:
+            with tf.Graph().as_default():
+                input_place = tf.placeholder(dtype=tf.float32, shape=[None, 4], name='input')
+                label_place = tf.placeholder(dtype=tf.float32, shape=[None, 3], name='label')
+                training = tf.placeholder(dtype=tf.bool, shape=[], name='training')
+                weight = tf.Variable(np.random.normal(size=[4, 3]).astype(np.float32))
+                output = tf.matmul(input_place, weight)
+                encoder = tf.cond(training, lambda: output * label_place, lambda: output)
+
+                with tf.Session() as sess:
+                    sess.run(tf.global_variables_initializer())
+                    expected = sess.run(encoder, feed_dict={input_place: data,
+                                                            label_place: np.zeros([10, 3]),
+                                                            training: False})
+                    with self.assertRaises(ValueError):
+                        export_frozen_graph(sess=sess, inputs={'input': input_place}, outputs={'encoder': encoder},
+                                            export_dir=temp_dir)
+                    export_frozen_graph(sess=sess,
+                                        inputs={'input': input_place},
+                                        outputs={'encoder': encoder},
+                                        export_dir=temp_dir,
+                                        defaults={'label': (label_place, 0), 'training': (training, False)})
+
+            graph = FrozenGraph(export_dir=temp_dir)
+            results = graph.run(data, batch_size=3)
+            graph.close()
+        np.testing.assert_allclose(results['encoder'], expected, rtol=1e-6)
+
+
+class TestHDF5Dataset(unittest.TestCase):
+
+    def test_contiguous_blocks(self):
+        """
+        A contiguous dataset must be read in blocks of many samples, and each sample yielded once.
+        """
+        with tempfile.TemporaryDirectory() as temp_dir:
+            with h5py.File(os.path.join(temp_dir, 'folds.hdf5'), 'w') as file:
+                data = np.arange(1000, dtype=np.float32).reshape([100, 10])
+                dataset = HDF5Dataset(file.create_dataset('train data', data=data), block_bytes=400)
+                self.assertEqual(dataset.block_size, 10)
+                batches = list(dataset.read_batches(batch_size=7, shuffle=True))
+
+        samples = np.concatenate(batches, axis=0)
+        np.testing.assert_array_equal(np.sort(samples[:, 0]), data[:, 0])
+
+
+class TestFoldCache(unittest.TestCase):
+
+    def test_memory_map(self):
+        """
+        The cached dataset must equal the source and start at a page boundary. It must be kept when other
+        datasets of the file are written, and rebuilt once the dataset changes.
+        """
+        with tempfile.TemporaryDirectory() as temp_dir:
+            file_path = os.path.join(temp_dir, 'folds.hdf5')
+            data = np.random.normal(size=[100, 5, 3]).astype(np.float32)
+            with h5py.File(file_path, 'w') as file:
+                file.create_dataset('fold 1/train data', data=data, chunks=(16, 5, 3), compression='gzip')
+
+            cache = FoldCache(cache_dir=os.path.join(temp_dir, 'cache'))
+            with h5py.File(file_path, 'r') as file:
+                cached = cache.get(file['fold 1/train data'])
+            self.assertEqual(cached.offset % FoldCache.alignment, 0)
+            self.assertFalse(cached.flags.writeable)
+            np.testing.assert_array_equal(cached, data)
+            cache_time = os.stat(cached.filename).st_mtime_ns
+
+            with h5py.File(file_path, 'a') as file:
+                file.create_dataset('fold 1/train data encoder', data=data)
+            with h5py.File(file_path, 'a') as file:
+                cached = cache.get(file['fold 1/train data'])
+            self.assertEqual(os.stat(cached.filename).st_mtime_ns, cache_time)
+
+            with h5py.File(file_path, 'a') as file:
+                file['fold 1/train data'][-1] = 0
+            with h5py.File(file_path, 'r') as file:
+                cached = cache.get(file['fold 1/train data'])
+            np.testing.assert_array_equal(cached[-1], 0)
+
+
+class TestLabel(unittest.TestCase):
+
+    def test_onehot_to_vector(self):
+        """
+        The argmax must be equivalent to the loop over classes, including the samples without class.
+        """
+        labels = np.eye(3)[np.random.randint(3, size=20)]
+        labels[0] = 0
+        for class_num in [2, 3]:
+            vector = np.zeros(shape=[20], dtype=int)
+            for class_index in range(class_num):
+                vector[np.where(labels[:, class_index] == 1)] = class_index
+            np.testing.assert_array_equal(onehot_to_vector(labels, class_num=class_num), vector)
+
+    def test_memoization(self):
+        """
+        The conversion of the same labels must be reused without keeping the labels alive, and the labels
+        of another array or hdf5 dataset must be converted again.
+        """
+        cache = LabelCache(max_size=2)
+        labels = np.eye(3)[[0, 1, 2, 1]]
+        vector = cache.convert(onehot_to_vector, labels)
+        self.assertIs(cache.convert(onehot_to_vector, labels), vector)
+        self.assertIsNot(cache.convert(onehot_to_vector, labels.copy()), vector)
+        self.assertFalse(np.shares_memory(vector, labels))
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            with h5py.File(os.path.join(temp_dir, 'labels.h5'), 'w') as file:
+                dataset = file.create_dataset('label', data=labels)
+                vector = cache.convert(onehot_to_vector, dataset)
+                np.testing.assert_array_equal(vector, [0, 1, 2, 1])
+                self.assertIs(cache.convert(onehot_to_vector, file['label']), vector)
+
+                del file['label']
+                file.create_dataset('label', data=np.eye(3)[[2, 2]])
+                np.testing.assert_array_equal(cache.convert(onehot_to_vector, file['label']), [2, 2])
+
+        samples = flatten_samples(np.ones(shape=[4, 2, 3], dtype=np.float32))
+        self.assertEqual(samples.shape, (4, 6))
+        self.assertEqual(samples.dtype, np.float32)
+        self.assertFalse(np.shares_memory(cache.convert(flatten_samples, samples), samples))
+
+
+class TestTrainingController(unittest.TestCase):
+
+    def test_early_stopping(self):
+        """
+        Training must stop once the validation MSE has not improved for patience epochs.
+        """
+        controller = TrainingController(training_cycle=100, test_cycle=1, patience=3)
+        valid_mses = [5, 4, 3, 3, 3, 3, 3, 3]
+        for epoch, valid_mse in enumerate(valid_mses):
+            self.assertTrue(controller.should_validate(epoch=epoch))
+            controller.update(epoch=epoch, valid_mse=valid_mse)
+            if controller.stop:
+                break
+        self.assertEqual(epoch + 1, 6)
+        self.assertEqual(controller.best_epoch, 3)
+
+    def test_adaptive_cycle(self):
+        """
+        The interval between validations must double after improvements and reset once they stall.
+        """
+        controller = TrainingController(training_cycle=100, test_cycle=1, adaptive=True, max_test_cycle=4)
+        validations = list()
+        for epoch in range(20):
+            if controller.should_validate(epoch=epoch):
+                validations.append(epoch + 1)
+                controller.update(epoch=epoch, valid_mse=1. / (epoch + 1) if epoch < 10 else 1.)
+        self.assertEqual(validations, [1, 3, 7, 11, 12, 13, 14, 15, 16, 17, 18, 19, 20])
+
+    def test_cycle_capped_at_patience(self):
+        """
+        The interval between validations must not exceed patience, so that a single stalled validation
+        does not stop training.
+        """
+        controller = TrainingController(training_cycle=100, test_cycle=1, patience=3, adaptive=True,
+                                        max_test_cycle=8)
+        validations = list()
+        for epoch in range(100):
+            if controller.should_validate(epoch=epoch):
+                validations.append(epoch + 1)
+                controller.update(epoch=epoch, valid_mse=1. / (epoch + 1) if epoch < 10 else 1.)
+                if controller.stop:
+                    break
+        self.assertEqual(validations, [1, 3, 6, 9, 12])
+        self.assertEqual(controller.best_epoch, 9)
+
+
+class TestRunManifest(unittest.TestCase):
+
+    def test_best(self):
+        """
+        The best checkpoint must be the valid one with the lowest validation MSE, not the latest.
+        """
+        with tempfile.TemporaryDirectory() as temp_dir:
+            manifest = RunManifest(file_path=os.path.join(temp_dir, 'manifest.jsonl'))
+            stage = {'fold': 'fold 1', 'process': 'fine_tune_SCAE', 'indexes': None}
+            for epoch, valid_mse in [(1, 3.), (2, 1.), (3, 2.), (4, None), (5, 0.5)]:
+                save_path = os.path.join(temp_dir, 'train.model_{:d}'.format(epoch))
+                if epoch != 5:
+                    open(save_path + '.index', 'w').close()
+                manifest.add(epoch=epoch,
+                             save_path=save_path,
+                             metrics={'Valid MSE': valid_mse} if valid_mse is not None else None,
+                             **stage)
+
+            self.assertEqual(manifest.best(**stage)['epoch'], 2)
+            self.assertEqual(manifest.latest(**stage)['epoch'], 4)
+            self.assertIsNone(manifest.best(fold='fold 2', process='fine_tune_SCAE'))
+
 
-a_ = None
-for a in a_:
-    print(a)
+if __name__ == '__main__':
+    unittest.main()
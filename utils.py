@@ -3,13 +3,12 @@ import numpy as np
 import scipy.io as sio
 # from Structure.classfier import Classifier, SupportVectorMachine
 from data.utils_prepare_data import hdf5_handler
+from Structure.dataset import HDF5Dataset
+from Structure import label
 
 
 def onehot_to_vector(data, class_num=2):
-    data_tmp = np.zeros(shape=[np.size(data, 0)], dtype=int)
-    for class_index in range(class_num):
-        data_tmp[np.where(data[:, class_index] == 1)] = class_index
-    return data_tmp
+    return label.onehot_to_vector(data, class_num=class_num)
 
 
 # def run_classifier(folds=None, neural_network: Classifier = None):
@@ -55,14 +54,19 @@ def calculate_MSE(folds: h5py.Group = None, model=None):
             tvt_data = '{:s} data'.format(tvt)
             tvt_reconstruction = '{:s} data output'.format(tvt)
 
-            data = np.array(fold[tvt_data])
+            data = HDF5Dataset(fold[tvt_data])
             if model is None:
                 try:
-                    reconstruction = np.array(fold[tvt_reconstruction])
-                    square_error = np.square(np.subtract(data, reconstruction))
-                    for i in range(len(np.shape(square_error)) - 1):
-                        square_error = np.mean(square_error, -1)
-                    mses = square_error
+                    reconstruction = HDF5Dataset(fold[tvt_reconstruction])
+                    mses = list()
+                    # Compare the data with its reconstruction block by block
+                    for start in range(0, len(data), data.buffer_size):
+                        stop = start + data.buffer_size
+                        square_error = np.square(np.subtract(data[start:stop], reconstruction[start:stop]))
+                        for i in range(len(np.shape(square_error)) - 1):
+                            square_error = np.mean(square_error, -1)
+                        mses.append(square_error)
+                    mses = np.concatenate(mses, 0)
                 except:
                     return
             else:
@@ -77,11 +81,9 @@ def get_slice(dataset, feature, fold_idx, subject_idx, slice_idx):
     hdf5_path = 'F:/OneDriveOffL/Data/Data/{:s}/{:s}.hdf5'.format(dataset.upper(), dataset.lower()).encode()
     hdf5 = hdf5_handler(hdf5_path, 'a')
     fold = hdf5['experiments/{:s}_whole/{:s}'.format(feature, fold_idx)]
-    train_data = np.array(fold['train data'])
-    train_data_reconstruction = np.array(fold['train data output'])
-
-    data_slice = train_data[subject_idx * 61 + slice_idx]
-    recons_slice = train_data_reconstruction[subject_idx * 61 + slice_idx]
+    # Read the required slice only
+    data_slice = np.array(fold['train data'][subject_idx * 61 + slice_idx])
+    recons_slice = np.array(fold['train data output'][subject_idx * 61 + slice_idx])
 
     shape = np.shape(data_slice)
     data_slice = np.reshape(data_slice, [shape[0], shape[1]])